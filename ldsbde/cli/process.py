@@ -4,7 +4,7 @@ from functools import partial
 
 import click
 
-from ldsbde.cli.utils import with_config, singleton, with_bde, with_job, save_job, load_job
+from ldsbde.cli.utils import with_config, singleton, with_bde, with_job, save_job, save_all, load_job, find_older_jobs
 from ldsbde.core.job import Job
 
 
@@ -41,8 +41,8 @@ def start(ctx, job_id, bde):
 
     # at this point we don't really do anything except create the .yml file
     job = Job.create(job_id, save_func=partial(save_job, ctx))
-    ctx.bde.update_job(job)
-    job.save()
+    bde.each_target(job, lambda bde, job: bde.update_job(job))
+    save_all(job)
     L.info(str(job))
 
 
@@ -63,8 +63,12 @@ def finish(ctx, job, bde):
         EOF
     """
     L.info("process-finish: job_id=%s", job.id)
-    bde.start_update(job)
-    job.save()
+    older_jobs = find_older_jobs(ctx, job)
+    bde.each_target(job, lambda bde, job: bde.start_update(
+        job,
+        older_jobs=[bde.own_job(j) for j in older_jobs]
+    ))
+    save_all(job)
     L.info(str(job))
 
 
@@ -85,6 +89,6 @@ def error(ctx, job, bde):
         EOF
     """
     L.info("process-error: job_id=%s", job.id)
-    bde.error_update(job)
-    job.save()
+    bde.each_target(job, lambda bde, job: bde.error_update(job))
+    save_all(job)
     L.info(str(job))
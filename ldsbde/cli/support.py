@@ -2,12 +2,15 @@ import json
 import logging
 from functools import partial
 import os
+import time
 
 import click
 
-from ldsbde.cli.utils import with_config, with_bde, with_job, singleton, load_job, save_job, find_jobs
+from ldsbde.cli.utils import with_config, with_bde, with_job, singleton, singleton_lock, load_job, save_job, save_all, find_jobs, find_older_jobs, archive_jobs
 from ldsbde.core.job import Job
 from ldsbde.core.bde import BDEProcessor
+from ldsbde.core.status import StatusBoard, StatusServer
+from ldsbde.core.util import elapsed_seconds, timestamp_local
 
 
 L = logging.getLogger("ldsbde.support")
@@ -58,18 +61,27 @@ def continue_import(ctx, ignore_bde_state, ignore_schedule, job, bde):
     Continue the import-starting stage.
 
     This is appropriate if it had eg. API errors setting up imports or creating the Publish.
-    Ignores layer versions with the same import-ref.
+    Only layers whose imports weren't started are touched, and Publishes are
+    created from the recorded layer versions.
     """
     L.info("continue-import job_id=%s", job.id)
     if job.state not in (Job.STATE_BDE_FINISHED, Job.STATE_ERRORS):
         raise click.ClickException("Invalid job state for continue-import: %s" % job.state)
 
-    bde.start_update(
-        job,
-        check_bde_state=(not ignore_bde_state),
-        ignore_schedule=ignore_schedule
-    )
-    job.save()
+    older_jobs = find_older_jobs(ctx, job)
+
+    def start(bde, job):
+        if job.target_name and job.state not in (Job.STATE_BDE_FINISHED, Job.STATE_ERRORS, Job.STATE_NEW):
+            L.info("Target %s: not continuing, job is %s", job.target_name, job.state)
+            return
+        bde.start_update(
+            job,
+            check_bde_state=(not ignore_bde_state),
+            ignore_schedule=ignore_schedule,
+            older_jobs=[bde.own_job(j) for j in older_jobs]
+        )
+    bde.each_target(job, start)
+    save_all(job)
     click.echo(str(job))
 
 
@@ -101,17 +113,19 @@ def start_import(ctx, ignore_bde_state, ignore_schedule, job_id, bde):
 
     # create the .yml file
     job = Job.create(job_id, save_func=partial(save_job, ctx))
-    ctx.bde.update_job(job)
-    job.save()
+    bde.each_target(job, lambda bde, job: bde.update_job(job))
+    save_all(job)
     L.info("BDE Job:\n%s", str(job))
 
     L.info("Starting update...")
-    bde.start_update(
+    older_jobs = find_older_jobs(ctx, job)
+    bde.each_target(job, lambda bde, job: bde.start_update(
         job,
         check_bde_state=(not ignore_bde_state),
-        ignore_schedule=ignore_schedule
-    )
-    job.save()
+        ignore_schedule=ignore_schedule,
+        older_jobs=[bde.own_job(j) for j in older_jobs]
+    ))
+    save_all(job)
     click.echo(str(job))
 
 
@@ -130,31 +144,108 @@ def cron_monitor(ctx, max_age, bde):
         */15 * * * * /path/to/lds-bde-loader/bin/lds-bde-loader cron-monitor --max-age=7
     """
     L.info("cron-monitor max-age=%s", max_age)
+    jobs, errors = _monitor(ctx, bde, max_age)
+    if errors:
+        # the rest have been saved, fail the cron run
+        raise errors[0]
+
 
+def _monitor(ctx, bde, max_age):
+    """
+    Check & progress the latest job and jobs from the previous max_age days,
+    then archive old jobs if archive_after is set and there weren't errors.
+    Returns the checked jobs & a list of errors.
+    """
     upload = bde.get_latest_upload()
     if not upload:
         L.warn("No latest BDE Processor Upload")
-        return
+        return [], []
 
     # Check the latest job
+    jobs = []
     try:
-        job = load_job(ctx, upload.id)
+        jobs.append(load_job(ctx, upload.id))
     except Job.NotFound:
         L.warn("No matching Job found for Upload %s", upload.id)
-    else:
-        bde.update_job(job)
-        job.save()
 
     if max_age:
         # Check older jobs
         for job in find_jobs(ctx, max_age=max_age):
             if job.id == upload.id:
-                # we've already done this one above
+                # we've already got this one above
                 continue
+            jobs.append(job)
+
+    L.info("Checking jobs: %s", ", ".join(str(job.id) for job in jobs))
+    errors = []
+    for job, e in bde.monitor_jobs(jobs):
+        save_all(job, modified_only=True)
+        if e:
+            L.error("Job %s: %s", job.id, e)
+            errors.append(e)
 
-            L.info("Checking older job: %s", job.id)
-            bde.update_job(job)
-            job.save()
+    if not errors and ctx.config.get('archive_after') is not None:
+        archived = archive_jobs(ctx, ctx.config['archive_after'])
+        if archived:
+            L.info("Archived jobs: %s", ", ".join(str(job.id) for job in archived))
+    return jobs, errors
+
+
+@click.command('monitor')
+@with_config
+@with_bde
+@click.option("--max-age", metavar="DAYS", help="Also check jobs from previous N days", type=click.IntRange(min=0), default=7)
+@click.option("--interval", metavar="SECONDS", help="Time between checks", type=click.IntRange(min=1), default=900)
+@click.option("--status", "status_address", metavar="[HOST:]PORT", help="Serve job status as JSON over HTTP (default: monitor.status)")
+@click.pass_context
+def monitor(ctx, max_age, interval, status_address, bde):
+    """
+    Check and progress current imports continuously.
+
+    Does what cron-monitor does every --interval seconds. Each check takes
+    the lock other commands use (waiting for them to finish), and releases
+    it until the next, so check-import, abandon etc. can run in between.
+    With --status, the
+    state of the monitored jobs is served read-only from memory at
+    http://HOST:PORT/jobs and /jobs/ID, where ?since=VERSION&wait=SECONDS
+    long-polls for changes.
+    """
+    status_address = status_address or (ctx.config.get('monitor') or {}).get('status')
+    L.info("monitor max-age=%s interval=%s status=%s", max_age, interval, status_address)
+
+    board = server = None
+    if status_address:
+        host, _, port = str(status_address).rpartition(':')
+        board = StatusBoard()
+        server = StatusServer(board, host=(host or '127.0.0.1'), port=int(port))
+        server.start()
+
+    try:
+        while True:
+            started_at = timestamp_local()
+            try:
+                with singleton_lock(wait=True):
+                    try:
+                        jobs, errors = _monitor(ctx, bde, max_age)
+                    finally:
+                        bde.flush_caches()
+            except Exception as e:
+                # eg. the BDE database is unavailable, try again next time
+                L.exception("Monitor check failed")
+                jobs, errors = None, [e]
+
+            if board:
+                board.update(
+                    jobs,
+                    checked_at=started_at,
+                    check_seconds=round(elapsed_seconds(started_at), 1),
+                    next_check_in=interval,
+                    errors=[str(e) for e in errors],
+                )
+            time.sleep(interval)
+    finally:
+        if server:
+            server.stop()
 
 
 @click.command('check-import')
@@ -162,7 +253,7 @@ def cron_monitor(ctx, max_age, bde):
 @with_bde
 @singleton(wait=False)
 @click.option("--job-state", help="Treat as if the current job state as this", type=click.Choice([Job.STATE_NEW, Job.STATE_BDE_RUNNING, Job.STATE_BDE_ERROR, Job.STATE_BDE_FINISHED, Job.STATE_IMPORTING]))
-@click.option("--verify", help="Layer verification level", type=click.Choice([BDEProcessor.VERIFY_ALL, BDEProcessor.VERIFY_COUNTS, BDEProcessor.VERIFY_NONE]), default=BDEProcessor.VERIFY_ALL)
+@click.option("--verify", help="Layer verification level (default: bde.verify)", type=click.Choice([BDEProcessor.VERIFY_ALL, BDEProcessor.VERIFY_COUNTS, BDEProcessor.VERIFY_CHECKSUM, BDEProcessor.VERIFY_TWO_PHASE, BDEProcessor.VERIFY_NONE]))
 @with_job
 @click.pass_context
 def check_import(ctx, job_state, verify, job, bde):
@@ -172,8 +263,10 @@ def check_import(ctx, job_state, verify, job, bde):
     Progressing it as appropriate (eg. approving publishes, updating state, etc)
     """
     L.info("check-import job_id=%s job_state=%s verify=%s", job.id, job_state, verify)
-    bde.update_job(job, job_state=job_state, verify=verify)
-    job.save()
+    if verify == BDEProcessor.VERIFY_CHECKSUM:
+        bde.start_checksum_pool()
+    bde.each_target(job, lambda bde, job: bde.update_job(job, job_state=job_state, verify=verify))
+    save_all(job)
     click.echo(str(job))
 
 
@@ -190,8 +283,8 @@ def abandon(ctx, job, bde):
     Specifically, cancels the publish.
     """
     L.info("abandon job_id=%s", job.id)
-    bde.abandon_update(job)
-    job.save()
+    bde.each_target(job, lambda bde, job: bde.abandon_update(job))
+    save_all(job)
     click.echo(str(job))
 
 
@@ -213,3 +306,100 @@ def error_email(ctx, job, bde):
 
     bde.email_errors(job)
     click.echo(str(job))
+
+
+@click.command('count-benchmark')
+@with_config
+@with_bde
+@click.option("--revision", type=int, help="BDE revision to count at (default: latest)")
+@click.option("--repeat", type=click.IntRange(min=1), default=1, help="Number of timed runs per strategy")
+@click.argument('tables', nargs=-1)
+@click.pass_context
+def count_benchmark(ctx, revision, repeat, tables, bde):
+    """
+    Compare BDE row-count strategies.
+
+    Times counting each configured table (or just TABLES) via the table_version
+    revision table vs ver_get_*_revision(), and checks the counts agree.
+    """
+    if revision is None:
+        revision = bde.get_bde_revision()
+    tables = tables or sorted(bde.config.table_layers)
+    strategies = (BDEProcessor.COUNT_REVISION_TABLE, BDEProcessor.COUNT_FUNCTION)
+
+    click.echo("Revision %s" % revision)
+    mismatches = 0
+    for table in tables:
+        results = {}
+        for strategy in strategies:
+            timings = []
+            for i in range(repeat):
+                start = time.time()
+                count = bde.get_bde_row_count(table, revision, strategy=strategy)
+                timings.append(time.time() - start)
+            results[strategy] = (count, min(timings))
+
+        counts = set(count for count, _ in results.values())
+        if len(counts) > 1:
+            mismatches += 1
+        click.echo("%s: %s%s" % (
+            table,
+            ", ".join("%s=%s rows in %.2fs" % (s, results[s][0], results[s][1]) for s in strategies),
+            " MISMATCH" if len(counts) > 1 else "",
+        ))
+
+    if mismatches:
+        raise click.ClickException("%d tables had mismatched counts" % mismatches)
+
+
+@click.command('plan')
+@with_config
+@with_bde
+@click.option("--ignore-schedule", is_flag=True, help="Ignore the configured schedules")
+@click.option("--no-lookup", is_flag=True, help="Don't look up existing draft versions via the API")
+@click.argument('job_id', type=int, required=True)
+@click.pass_context
+def plan(ctx, ignore_schedule, no_lookup, job_id, bde):
+    """
+    Dry-run: show what starting an import would do.
+
+    Lists the groups & layers that would be started today, the Koordinates API
+    calls and BDE queries expected, and import durations estimated from
+    previous imports, as JSON. Nothing is changed or saved.
+    """
+    L.info("plan job_id=%s", job_id)
+    try:
+        job = load_job(ctx, job_id)
+    except Job.NotFound:
+        # not started yet, plan from a blank Job which is never saved
+        job = Job.create(job_id)
+
+    plans = bde.each_target(job, lambda bde, job: bde.plan_update(
+        job,
+        ignore_schedule=ignore_schedule,
+        lookup=(not no_lookup)
+    ))
+    click.echo(json.dumps({'job': job_id, 'state': job.state, 'targets': plans}, indent=2, sort_keys=True, default=str))
+
+
+@click.command('archive')
+@with_config
+@singleton(wait=False)
+@click.option("--max-age", metavar="DAYS", type=click.IntRange(min=0), help="Archive finished jobs created more than N days ago (default: archive_after, or 30)")
+@click.option("--dry-run", is_flag=True, help="Only list the jobs which would be archived")
+@click.pass_context
+def archive(ctx, max_age, dry_run):
+    """
+    Archive old finished jobs.
+
+    Moves the job files into monthly zip bundles in job_path/archive. Archived
+    jobs can still be shown & loaded by ID.
+    """
+    if max_age is None:
+        max_age = ctx.config.get('archive_after')
+        if max_age is None:
+            max_age = 30
+    L.info("archive max-age=%s dry-run=%s", max_age, dry_run)
+
+    for job in archive_jobs(ctx, max_age, dry_run=dry_run):
+        click.echo("%s %s (%s)" % ("Would archive" if dry_run else "Archived", job.id, job.state))
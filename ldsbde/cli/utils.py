@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import contextlib
 import datetime
 import fcntl
 import logging
@@ -11,6 +12,8 @@ from functools import update_wrapper, partial
 import click
 import yaml
 
+from ldsbde.core import config, dbwait, exc
+from ldsbde.core.archive import JobArchive
 from ldsbde.core.bde import BDEProcessor
 from ldsbde.core.job import Job
 
@@ -36,8 +39,11 @@ def with_config(func):
         else:
             raise click.ClickException("Config file not found. Run 'lds-bde-loader init'")
 
-        with open(config_path, 'r') as fd:
-            ctx.config = yaml.safe_load(fd)
+        cache_dir = os.path.join(click.get_app_dir('lds-bde-loader', force_posix=True), 'cache')
+        try:
+            ctx.config = config.load(config_path, cache_dir=cache_dir)
+        except exc.ConfigError as e:
+            raise click.ClickException("%s: %s" % (config_path, e.msg))
 
         # re-configure logging
         if 'logging' in ctx.config:
@@ -62,34 +68,54 @@ def with_config(func):
     return f(func)
 
 
+def _lock(wait):
+    """ Take the lds-bde-loader process lock, returning the locked file """
+    pid_file = os.path.join(tempfile.gettempdir(), 'lds-bde-loader.lock')
+
+    flags = fcntl.LOCK_EX
+    if not wait:
+        flags |= fcntl.LOCK_NB
+
+    pid_fp = open(pid_file, 'w')
+    try:
+        fcntl.lockf(pid_fp, flags)
+    except IOError:
+        # another instance is running
+        pid_fp.close()
+        raise click.ClickException("Another instance of 'lds-bde-loader process' is running")
+    return pid_fp
+
+
 def singleton(wait):
     """
     Prevent multiple lds-bde-loader processes fighting each other.
     wait should be a boolean whether to block/wait for the other process or not.
+    The lock is held until the process exits.
     """
     def wrap(func):
         @click.pass_context
         def wrapper(ctx, *args, **kwargs):
             # check we're the only @singleton command running
-            pid_file = os.path.join(tempfile.gettempdir(), 'lds-bde-loader.lock')
-
-            flags = fcntl.LOCK_EX
-            if not wait:
-                flags |= fcntl.LOCK_NB
-
-            ctx.pid_fp = open(pid_file, 'w')
-            try:
-                fcntl.lockf(ctx.pid_fp, flags)
-            except IOError:
-                # another instance is running
-                ctx.pid_fp.close()
-                raise click.ClickException("Another instance of 'lds-bde-loader process' is running")
-
+            ctx.pid_fp = _lock(wait)
             return ctx.invoke(func, *args, **kwargs)
         return update_wrapper(wrapper, func)
     return wrap
 
 
+@contextlib.contextmanager
+def singleton_lock(wait):
+    """
+    Hold the same lock as @singleton commands for a block, for long-running
+    commands that only need it while they're changing jobs.
+    """
+    pid_fp = _lock(wait)
+    try:
+        yield
+    finally:
+        # closing releases the lock
+        pid_fp.close()
+
+
 def with_bde(func):
     """
     Populate a ldsbde.core.BDEProcessor instance as the bde argument.
@@ -101,33 +127,115 @@ def with_bde(func):
             L.debug("No 'bde' section in config")
             raise click.ClickException("This lds-bde-loader isn't configured for BDE Processor operation. Edit the config file.")
 
+        # cancel any running BDE queries if we're killed
+        dbwait.install_signal_handlers()
+
         bde = BDEProcessor(ctx.config)
         ctx.bde = bde
-        return ctx.invoke(func, bde=bde, *args, **kwargs)
+        try:
+            result = ctx.invoke(func, bde=bde, *args, **kwargs)
+        finally:
+            bde.close()
+            bde.log_metrics()
+
+        overruns = bde.check_budget(ctx.command.name)
+        if overruns and bde.budget_action == BDEProcessor.BUDGET_FAIL:
+            raise click.ClickException("Over budget: %s" % "; ".join(overruns))
+        return result
     return update_wrapper(wrapper, func)
 
 
 
+def _job_file(ctx, job_id, target_name=None):
+    """ Jobs for extra Koordinates targets are stored in N.<target>.yml """
+    if target_name:
+        filename = '%s.%s.yml' % (job_id, target_name)
+    else:
+        filename = '%s.yml' % job_id
+    return os.path.join(ctx.config["job_path"], filename)
+
+
 def save_job(ctx, job):
     """ Serialize the job out to a YAML file """
-    job_path = ctx.config["job_path"]
-    job_file = os.path.join(job_path, '%s.yml' % job.id)
+    job_file = _job_file(ctx, job.id, job.target_name)
     with open(job_file, 'w') as fd:
         yaml.safe_dump(job.serialize(), fd, default_flow_style=False)
 
 
+def save_all(job, modified_only=False):
+    """ Save a job and the jobs for its extra targets """
+    for j in job.with_targets():
+        if j.is_modified() or not modified_only:
+            j.save()
+
+
+def get_archive(ctx):
+    """ The JobArchive for job_path """
+    if not hasattr(ctx, 'archive'):
+        ctx.archive = JobArchive(os.path.join(ctx.config["job_path"], 'archive'))
+    return ctx.archive
+
+
 def load_job(ctx, job_id):
-    """ Load a Job from on-disk as a yaml file. """
+    """
+    Load a Job from on-disk as a yaml file.
+    Falls back to the archive if it's been archived. Saving an archived Job
+    writes it back to job_path.
+    """
+    job_file = _job_file(ctx, job_id)
+    if os.path.exists(job_file):
+        with open(job_file, 'r') as fd:
+            data = yaml.safe_load(fd)
+
+        targets = {}
+        for name in getattr(ctx.config, 'targets', {}):
+            target_file = _job_file(ctx, job_id, name)
+            if os.path.exists(target_file):
+                with open(target_file, 'r') as fd:
+                    targets[name] = yaml.safe_load(fd)
+    else:
+        archived = get_archive(ctx).read(job_id)
+        if archived is None:
+            raise Job.NotFound("Job %s (%s)" % (job_id, job_file))
+
+        job_file = os.path.basename(job_file)
+        data = yaml.safe_load(archived.get(job_file, ''))
+        targets = {}
+        for name in getattr(ctx.config, 'targets', {}):
+            target_file = os.path.basename(_job_file(ctx, job_id, name))
+            if target_file in archived:
+                targets[name] = yaml.safe_load(archived[target_file])
+
+    if not data:
+        raise Job.NotFound("Job %s (%s) -- empty" % (job_id, job_file))
+
+    return Job.parse(data, job_id=job_id, save_func=partial(save_job, ctx), targets=targets)
+
+
+def archive_jobs(ctx, max_age, dry_run=False):
+    """
+    Move the files for Jobs in terminal states created more than max_age days
+    ago from job_path into the archive. Returns the archived Jobs.
+    """
     job_path = ctx.config["job_path"]
-    job_file = os.path.join(job_path, '%s.yml' % job_id)
-    if not os.path.exists(job_file):
-        raise Job.NotFound("Job %s (%s)" % (job_id, job_file))
+    filenames = os.listdir(job_path)
+    oldest = datetime.date.today() - datetime.timedelta(days=max_age)
+    archive = get_archive(ctx)
+
+    archived = []
+    for job in find_jobs(ctx):
+        if job.created_at.date() >= oldest or not all(j.state in Job.TERMINAL_STATES for j in job.with_targets()):
+            continue
 
-    with open(job_file, 'r') as fd:
-        data = yaml.safe_load(fd)
-        if not data:
-            raise Job.NotFound("Job %s (%s) -- empty" % (job_id, job_file))
-        return Job.parse(data, job_id=job_id, save_func=partial(save_job, ctx))
+        paths = [os.path.join(job_path, fn) for fn in JobArchive.job_filenames(job.id, filenames)]
+        archived.append(job)
+        if dry_run:
+            continue
+
+        archive.add(job, paths)
+        for path in paths:
+            os.remove(path)
+    return archived
 
 
 def find_jobs(ctx, max_age=None):
@@ -158,6 +266,16 @@ def find_jobs(ctx, max_age=None):
         yield job
 
 
+def find_older_jobs(ctx, job, max_age=7):
+    """
+    Find the still-running Jobs older than job, for bde.coalesce.
+    Returns an empty list if coalescing isn't enabled.
+    """
+    if not ctx.bde.coalesce:
+        return []
+    return [j for j in find_jobs(ctx, max_age=max_age) if j.id < job.id and j.state in (Job.STATE_BDE_FINISHED, Job.STATE_IMPORTING)]
+
+
 def with_job(func):
     """
     Populate a ldsbde.job.Job instance as the job argument
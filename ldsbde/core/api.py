@@ -0,0 +1,357 @@
+import logging
+import random
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from email.utils import parsedate_tz, mktime_tz
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import koordinates
+import requests
+import requests.adapters
+import requests.exceptions
+from requests.compat import urlparse
+
+from ldsbde.core.throttle import AdaptiveConcurrency, TokenBucket
+
+
+# transient errors worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# POSTs aren't idempotent, only retry when the server definitely didn't process them
+RETRY_STATUSES_POST = (429, 503)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+# recent successful request durations kept per endpoint, for hedging thresholds
+LATENCY_WINDOW = 200
+
+
+class Metrics(object):
+    """ Thread-safe per-endpoint request counts & timings """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = defaultdict(lambda: {
+            'calls': 0,
+            'errors': 0,
+            'retries': 0,
+            'time': 0.0,
+            'max_time': 0.0,
+            'hedges': 0,
+            'hedge_wins': 0,
+        })
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+
+    @staticmethod
+    def endpoint(method, url):
+        """ Normalise a request to an endpoint name, eg. 'GET /layers/{id}/versions/{id}/' """
+        path = urlparse(url).path
+        path = re.sub(r'^/services/api/v[0-9.]+', '', path)
+        path = re.sub(r'/[0-9]+(?=/|$)', '/{id}', path)
+        return "%s %s" % (method.upper(), path)
+
+    def record(self, endpoint, elapsed, error=False, retry=False):
+        with self._lock:
+            stats = self.endpoints[endpoint]
+            stats['calls'] += 1
+            stats['time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            if error:
+                stats['errors'] += 1
+            else:
+                self.latencies[endpoint].append(elapsed)
+            if retry:
+                stats['retries'] += 1
+
+    def record_hedge(self, endpoint, won):
+        """ A duplicate request was sent, won if its response was the one used """
+        with self._lock:
+            stats = self.endpoints[endpoint]
+            stats['hedges'] += 1
+            if won:
+                stats['hedge_wins'] += 1
+
+    def percentile(self, endpoint, percent, min_samples=20):
+        """ The percent-th percentile of recent successful request durations, or None without enough samples """
+        with self._lock:
+            samples = sorted(self.latencies[endpoint])
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+    def counts(self):
+        """ {endpoint: number of calls} """
+        with self._lock:
+            return dict((endpoint, stats['calls']) for endpoint, stats in self.endpoints.items())
+
+    def summary(self):
+        """ Return a list of summary lines, one per endpoint """
+        with self._lock:
+            lines = []
+            for endpoint, stats in sorted(self.endpoints.items()):
+                line = "%s: %d calls, %d errors, %d retries, %.1fs total, %.1fs max" % (
+                    endpoint, stats['calls'], stats['errors'], stats['retries'], stats['time'], stats['max_time']
+                )
+                if stats['hedges']:
+                    line += ", %d hedged (%d won)" % (stats['hedges'], stats['hedge_wins'])
+                lines.append(line)
+            return lines
+
+
+class TransportSession(requests.Session):
+    """
+    requests.Session with a pooled keep-alive connection adapter, default
+    connect/read timeouts, and retries of transient errors (5xx/429/connection
+    problems) with jittered exponential backoff, respecting Retry-After headers.
+
+    Requests are rate-limited with separate token buckets for reads and for
+    expensive writes (POSTs: draft creation, imports, publish create/approve),
+    and the number in flight is bounded by an AIMD concurrency controller.
+
+    With hedge set, a GET which hasn't returned within the hedge.percentile
+    latency of its endpoint is sent again, and whichever response arrives
+    first is used. Hedges are limited to hedge.max_ratio of GETs.
+    """
+    HEDGE_DEFAULTS = {
+        'percentile': 95,
+        'max_ratio': 0.05,
+        'min_samples': 20,
+        'min_delay': 1.0,
+    }
+
+    def __init__(self, connections=10, timeout=(10, 120), retries=5, backoff=2.0, backoff_max=120,
+                 rate_limit=None, concurrency=None, hedge=None):
+        super(TransportSession, self).__init__()
+        self.log = logging.getLogger("ldsbde.api")
+        self.metrics = Metrics()
+
+        # separate budgets for reads and expensive writes (POSTs)
+        rate_limit = rate_limit or {}
+        self.rate_limits = {
+            'read': TokenBucket(rate_limit.get('reads'), rate_limit.get('reads_burst')),
+            'write': TokenBucket(rate_limit.get('writes'), rate_limit.get('writes_burst')),
+        }
+        concurrency = dict(concurrency or {})
+        concurrency.setdefault('maximum', connections)
+        self.concurrency = AdaptiveConcurrency(**concurrency)
+
+        self.timeout = tuple(timeout) if isinstance(timeout, (list, tuple)) else timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+
+        self.hedge = None
+        if hedge:
+            self.hedge = dict(self.HEDGE_DEFAULTS)
+            if isinstance(hedge, dict):
+                self.hedge.update(hedge)
+        self._hedge_lock = threading.Lock()
+        self._gets = 0
+        self._hedges = 0
+
+        # size the connection pool for concurrent use
+        adapter = requests.adapters.HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        method = method.upper()
+        if self.hedge and method == 'GET' and not kwargs.get('stream'):
+            return self._hedged_request(method, url, *args, **kwargs)
+        return self._request(method, url, *args, **kwargs)
+
+    def _hedged_request(self, method, url, *args, **kwargs):
+        endpoint = self.metrics.endpoint(method, url)
+        with self._hedge_lock:
+            self._gets += 1
+        delay = self.metrics.percentile(endpoint, self.hedge['percentile'], self.hedge['min_samples'])
+        if delay is None:
+            return self._request(method, url, *args, **kwargs)
+        delay = max(delay, self.hedge['min_delay'])
+
+        results = queue.Queue()
+        lock = threading.Lock()
+        answered = []
+
+        def send(hedged):
+            try:
+                r = self._request(method, url, *args, **kwargs)
+            except Exception as e:
+                results.put((hedged, None, e))
+                return
+            with lock:
+                if answered:
+                    # the other request won, don't leave our connection checked out
+                    r.close()
+                    return
+                answered.append(hedged)
+            results.put((hedged, r, None))
+
+        def start(hedged):
+            t = threading.Thread(target=send, args=(hedged,), name="hedge" if hedged else "request")
+            t.daemon = True
+            t.start()
+
+        start(False)
+        try:
+            result = results.get(timeout=delay)
+        except queue.Empty:
+            result = None
+
+        if result is None and self._take_hedge():
+            self.log.debug("%s: no response after %.1fs, sending a hedged request", endpoint, delay)
+            start(True)
+            hedged, r, e = self._wait(results)
+            if e is not None:
+                # use the other one instead
+                hedged, r, e = self._wait(results)
+            self.metrics.record_hedge(endpoint, won=(hedged and e is None))
+        else:
+            hedged, r, e = result or self._wait(results)
+
+        if e is not None:
+            raise e
+        return r
+
+    def _take_hedge(self):
+        """ Whether another hedge is within hedge.max_ratio of GETs """
+        with self._hedge_lock:
+            if self._hedges + 1 > self.hedge['max_ratio'] * self._gets:
+                return False
+            self._hedges += 1
+            return True
+
+    @staticmethod
+    def _wait(results):
+        # with a timeout so Ctrl-C still works
+        while True:
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                pass
+
+    def _request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = self.metrics.endpoint(method, url)
+
+        rate_limit = self.rate_limits['write' if method == 'POST' else 'read']
+        attempt = 0
+        while True:
+            rate_limit.acquire()
+            with self.concurrency:
+                start = time.time()
+                try:
+                    r = super(TransportSession, self).request(method, url, *args, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    elapsed = time.time() - start
+                    self.concurrency.record(elapsed, error=True)
+                    delay = self._retry_delay(method, attempt, error=e)
+                    self.metrics.record(endpoint, elapsed, error=True, retry=(delay is not None))
+                    if delay is None:
+                        raise
+                    reason = e
+                else:
+                    elapsed = time.time() - start
+                    self.concurrency.record(elapsed, error=(r.status_code in RETRY_STATUSES))
+                    delay = self._retry_delay(method, attempt, response=r)
+                    self.metrics.record(endpoint, elapsed, error=(r.status_code >= 400), retry=(delay is not None))
+                    if delay is None:
+                        return r
+                    reason = "%s %s" % (r.status_code, r.reason)
+                    r.close()
+
+            attempt += 1
+            self.log.warn("%s: %s -- retrying in %.1fs (%d/%d)", endpoint, reason, delay, attempt, self.retries)
+            time.sleep(delay)
+
+    def _retry_delay(self, method, attempt, response=None, error=None):
+        """ Seconds to wait before retrying a failed request, or None if it shouldn't be retried """
+        if attempt >= self.retries:
+            return None
+
+        retry_after = 0
+        if response is not None:
+            statuses = RETRY_STATUSES if method in IDEMPOTENT_METHODS else RETRY_STATUSES_POST
+            if response.status_code not in statuses:
+                return None
+            retry_after = self._retry_after(response)
+        elif method not in IDEMPOTENT_METHODS and not isinstance(error, requests.exceptions.ConnectTimeout):
+            # the request may have been sent
+            return None
+
+        delay = random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt)))
+        return max(delay, retry_after)
+
+    @staticmethod
+    def _retry_after(response):
+        """ Parse a Retry-After header (seconds or a HTTP date) into seconds """
+        value = response.headers.get('Retry-After')
+        if not value:
+            return 0
+        try:
+            return max(0, int(value))
+        except ValueError:
+            parsed = parsedate_tz(value)
+            if parsed:
+                return max(0, mktime_tz(parsed) - time.time())
+        return 0
+
+
+class Client(object):
+    """
+    Wrapper around koordinates.Client with lds-bde-loader specific extensions.
+    Anything not defined here is passed through to the underlying client.
+
+    Requests go through a TransportSession.
+    """
+    TRANSPORT_OPTIONS = ('connections', 'timeout', 'retries', 'backoff', 'backoff_max', 'rate_limit', 'concurrency', 'hedge')
+
+    def __init__(self, host, token=None, **transport_kwargs):
+        self.log = logging.getLogger("ldsbde.api")
+        self._client = koordinates.Client(host=host, token=token)
+
+        # swap in our transport, keeping the auth/accept headers
+        session = TransportSession(**transport_kwargs)
+        session.headers.update(self._client._session.headers)
+        self._client._session = session
+        self.metrics = session.metrics
+
+    @classmethod
+    def from_config(cls, config):
+        """ Create a Client from the 'koordinates' config section """
+        kwargs = dict((k, config[k]) for k in cls.TRANSPORT_OPTIONS if k in config)
+        return cls(host=config['endpoint'], token=config['api_token'], **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def get_publish(self, publish_id, validators=None):
+        """
+        Conditionally GET a Publish.
+
+        validators is a dict of 'etag'/'last_modified' values from a previous
+        response (see the return value). Returns a (publish, validators) tuple,
+        publish is None if it hasn't changed since validators were issued (304).
+        """
+        validators = validators or {}
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        target_url = self.get_url('PUBLISH', 'GET', 'single', {'id': publish_id})
+        r = self.request('GET', target_url, headers=headers)
+        if r.status_code == 304:
+            self.log.debug("Publish %s: not modified", publish_id)
+            return None, validators
+
+        new_validators = {}
+        if r.headers.get('ETag'):
+            new_validators['etag'] = r.headers['ETag']
+        if r.headers.get('Last-Modified'):
+            new_validators['last_modified'] = r.headers['Last-Modified']
+
+        return self.publishing.create_from_result(r.json()), new_validators
@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import warnings
+import zipfile
+
+
+class JobArchive(object):
+    """
+    Compressed archive of finished Job files, so job_path stays small.
+
+    Job files (N.yml, and N.<target>.yml for extra Koordinates targets) are
+    stored in one zip bundle per month the Job was created, eg.
+    archive/jobs-2016-05.zip, with archive/index.json mapping Job IDs to
+    their bundle.
+    """
+    def __init__(self, path):
+        self.log = logging.getLogger("ldsbde.archive")
+        self.path = path
+        self.index_path = os.path.join(path, 'index.json')
+        self._lock = threading.RLock()
+        self._index = None
+
+    @staticmethod
+    def job_filenames(job_id, filenames):
+        """ The files for a Job from a list of filenames """
+        pattern = re.compile(r'%d(\.[^.]+)?\.yml$' % job_id)
+        return sorted(fn for fn in filenames if pattern.match(fn))
+
+    def _get_index(self):
+        if self._index is None:
+            index = {}
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'r') as fd:
+                    index = json.load(fd)
+            self._index = index
+        return self._index
+
+    def _save_index(self):
+        """ Atomically write the index """
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.index-')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(self._index, fp, indent=1, sort_keys=True)
+            os.rename(tmp_path, self.index_path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def __contains__(self, job_id):
+        with self._lock:
+            return str(job_id) in self._get_index()
+
+    def add(self, job, paths):
+        """
+        Add the files for a Job to its monthly bundle & the index.
+        The caller should remove the originals afterwards.
+        """
+        bundle = 'jobs-%s.zip' % job.created_at.strftime('%Y-%m')
+        with self._lock:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path, 0o770)
+
+            with zipfile.ZipFile(os.path.join(self.path, bundle), 'a', zipfile.ZIP_DEFLATED) as zf:
+                existing = set(zf.namelist())
+                for path in paths:
+                    name = os.path.basename(path)
+                    with open(path, 'rb') as fd:
+                        data = fd.read()
+                    if name in existing:
+                        if zf.read(name) == data:
+                            # added already by a run which stopped before removing the originals
+                            continue
+                        # re-archiving a Job that was loaded & saved again, the last copy wins
+                        with warnings.catch_warnings():
+                            warnings.simplefilter('ignore')
+                            zf.writestr(name, data)
+                    else:
+                        zf.writestr(name, data)
+
+            self._get_index()[str(job.id)] = bundle
+            self._save_index()
+        self.log.info("Archived job %s to %s", job.id, bundle)
+
+    def read(self, job_id):
+        """
+        Get the archived files for a Job as {filename: contents}.
+        Returns None if the Job isn't archived.
+        """
+        with self._lock:
+            bundle = self._get_index().get(str(job_id))
+        if not bundle:
+            return None
+
+        with zipfile.ZipFile(os.path.join(self.path, bundle), 'r') as zf:
+            return dict((name, zf.read(name)) for name in self.job_filenames(job_id, zf.namelist()))
@@ -1,20 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
 import datetime
-import itertools
 import logging
+import multiprocessing
+import os
+import re
+import tempfile
 import textwrap
+import threading
+import time
+import zipfile
 from collections import defaultdict
 
-import dateutil.rrule
 import koordinates
 import pkg_resources
 import psycopg2
-import psycopg2.extras
+import psycopg2.extensions
 
-from ldsbde.core import exc
+from ldsbde.core import api, checksum, db, dbwait, exc
+from ldsbde.core.cache import LRUCache, VersionCache
+from ldsbde.core.config import CompiledConfig
 from ldsbde.core.job import Job
-from ldsbde.core.util import timestamp_local
+from ldsbde.core.util import elapsed_seconds, parallel_map, timestamp_local
 
 
 class KoordinatesStateError(Exception):
@@ -23,6 +31,14 @@ class BDEProcessorError(Exception):
     pass
 class ConsistencyError(Exception):
     pass
+class VerificationDeferred(Exception):
+    """ Verification couldn't finish (timeouts, BDE database problems), retry next time """
+    pass
+class VerificationTimeout(VerificationDeferred):
+    pass
+class BDEUnavailable(Exception):
+    """ A BDE query failed for reasons other than the data, eg. a lost connection """
+    pass
 
 
 class Upload(object):
@@ -63,87 +79,286 @@ class Upload(object):
             'end_time': self.end_time,
         }
 
+class TargetLoggerAdapter(logging.LoggerAdapter):
+    """ Prefixes messages with the name of the Koordinates target they're about """
+    def process(self, msg, kwargs):
+        return "[%s] %s" % (self.extra['target'], msg), kwargs
+
+
 class BDEProcessor(object):
     VERIFY_ALL = 'all'
     VERIFY_COUNTS = 'counts'
     VERIFY_NONE = 'none'
+    VERIFY_CHECKSUM = 'checksum'
+    # least to most thorough
+    VERIFY_LEVELS = (VERIFY_COUNTS, VERIFY_ALL, VERIFY_CHECKSUM)
+    # approve on VERIFY_COUNTS, then VERIFY_ALL once publishing
+    VERIFY_TWO_PHASE = 'two-phase'
+
+    # group['post_publish_verification']['state'] for VERIFY_TWO_PHASE
+    POST_VERIFY_PENDING = 'pending'
+    POST_VERIFY_PASSED = 'passed'
+    POST_VERIFY_FAILED = 'failed'
+
+    ORDER_CONFIG = 'config'
+    ORDER_LONGEST_FIRST = 'longest-first'
+
+    # get_bde_row_count() strategies
+    COUNT_REVISION_TABLE = 'revision-table'
+    COUNT_FUNCTION = 'function'
+
+    # what to do when a command goes over its bde.budgets
+    BUDGET_WARN = 'warn'
+    BUDGET_FAIL = 'fail'
+
+    # Publish states where the publish hasn't started yet
+    PUBLISH_PENDING = ('waiting-for-time', 'waiting-for-items', 'waiting-for-approval')
+
+    # per-layer progress of start_update()
+    PROGRESS_DRAFT = 'draft'
+    PROGRESS_IMPORTING = 'importing'
+
+    # LayerVersion import states
+    IMPORT_OK = 'ok'
+    IMPORT_ERROR = 'error'
 
     class BDEError(exc.Error):
         pass
 
-    def __init__(self, config):
-        self.log = logging.getLogger("ldsbde.BDEProcessor")
+    def __init__(self, config, target=None):
+        """
+        target is the name of an extra Koordinates target (koordinates.targets)
+        this processor is for. Use BDEProcessor.targets rather than passing it.
+        """
+        self.target = target
+        self.log = logging.getLogger("ldsbde.BDEProcessor" + ('.%s' % target if target else ''))
 
         # specific-purpose loggers
         self.notify = logging.getLogger("notify")
         self.email = logging.getLogger("email")
+        if target:
+            self.notify = TargetLoggerAdapter(self.notify, {'target': target})
 
+        if not isinstance(config, CompiledConfig):
+            config = CompiledConfig(config)
         self.config = config
         self.config_bde = config['bde']
         self.config_api = config['koordinates']
         self.debug = config.get('debug', False)
 
-        self.validate_config(self.config_bde['tables'], self.config_bde['groups'])
+        self.koordinates_client = api.Client.from_config(self.config_api)
 
-        self.koordinates_client = koordinates.Client(host=self.config_api['endpoint'],
-                                                     token=self.config_api['api_token'])
-
-    def validate_config(self, tables, groups):
-        """ Validate that layers/tables/groups listed in the BDE config file are sane """
-        mapped_layer_ids = tables.keys()
-        published_layer_ids = list(itertools.chain(*[g['layers'] for g in groups]))
-
-        dupe_mapped = set([x for x in mapped_layer_ids if mapped_layer_ids.count(x) > 1])
-        if dupe_mapped:
-            raise exc.ConfigError("Repeated Layers in bde.tables: %s" % str(list(dupe_mapped)))
+        pool = self.config_bde.get('pool', {})
+        self.db = db.Database(
+            self.config_bde['database'],
+            min_connections=pool.get('min_connections', 1),
+            max_connections=pool.get('max_connections', self.config_bde.get('workers', 4)),
+            health_check_interval=pool.get('health_check_interval', 60),
+        )
 
-        dupe_published = set([x for x in published_layer_ids if published_layer_ids.count(x) > 1])
-        if dupe_published:
-            raise exc.ConfigError("Repeated Layers in bde.groups: %s" % str(list(dupe_published)))
+        # per-site cache files
+        suffix = '.%s' % target if target else ''
 
-        # convert to sets, we know they're unique now
-        mapped_layer_ids = set(mapped_layer_ids)
-        published_layer_ids = set(published_layer_ids)
+        # immutable LayerVersion metadata, shared between runs
+        self.version_cache = VersionCache(
+            os.path.join(config['job_path'], 'layer-versions%s.cache.json' % suffix),
+            max_size=self.config_bde.get('version_cache_size', 2000)
+        )
 
-        mapped_extra = mapped_layer_ids - published_layer_ids
-        if mapped_extra:
-            raise exc.ConfigError("Layers listed in bde.tables not in bde.groups: %s" % str(list(mapped_extra)))
+        # moving average of import durations per layer, for start ordering
+        self.import_history = LRUCache(
+            os.path.join(config['job_path'], 'import-durations%s.cache.json' % suffix),
+            max_size=max(1000, len(self.config.layer_tables))
+        )
 
-        publish_extra = published_layer_ids - mapped_layer_ids
-        if publish_extra:
-            raise exc.ConfigError("Layers listed in bde.groups not in bde.tables: %s" % str(list(publish_extra)))
+        # BDE row/change counts at fixed revisions never change, shared between runs & targets
+        self.bde_counts = LRUCache(
+            os.path.join(config['job_path'], 'bde-counts.cache.json'),
+            max_size=max(2000, 2 * len(self.config.table_layers))
+        )
+        # counts keys being queried right now -> {'done': Event, 'result': ...}
+        self._counts_inflight = {}
+        self._counts_lock = threading.Lock()
+        self.workers = self.config_bde.get('workers', 4)
+        self.monitor_workers = self.config_bde.get('monitor_workers', 4)
+        self.pipeline_verification = self.config_bde.get('pipeline_verification', False)
+        self.cancel_on_import_error = self.config_bde.get('cancel_on_import_error', False)
+        self.prestage = self.config_bde.get('prestage', False)
+        self.coalesce = self.config_bde.get('coalesce', False)
+        self.start_order = self.config_bde.get('start_order', self.ORDER_CONFIG)
+        if self.start_order not in (self.ORDER_CONFIG, self.ORDER_LONGEST_FIRST):
+            raise exc.ConfigError("Unknown bde.start_order: %s" % self.start_order)
+        self.row_count = self.config_bde.get('row_count', self.COUNT_REVISION_TABLE)
+        if self.row_count not in (self.COUNT_REVISION_TABLE, self.COUNT_FUNCTION):
+            raise exc.ConfigError("Unknown bde.row_count: %s" % self.row_count)
+        self.verify_batch_size = self.config_bde.get('verify_batch_size', 20)
+        self.verify_timeout = self.config_bde.get('verify_timeout', 1800)
+        self.verify_job_timeout = self.config_bde.get('verify_job_timeout', None)
+        self.verify = self.config_bde.get('verify', self.VERIFY_ALL)
+        if self.verify not in self.VERIFY_LEVELS + (self.VERIFY_TWO_PHASE, self.VERIFY_NONE):
+            raise exc.ConfigError("Unknown bde.verify: %s" % self.verify)
+        checksum_config = self.config_bde.get('checksum', {})
+        self.checksum_processes = checksum_config.get('processes', multiprocessing.cpu_count())
+        self.checksum_batch_size = checksum_config.get('batch_size', 10000)
+        self.checksum_ignore_columns = set(c.lower() for c in checksum_config.get('ignore_columns', []))
+        self.export_timeout = checksum_config.get('export_timeout', 3600)
+        self.export_poll_interval = checksum_config.get('export_poll_interval', 10)
+        self._checksum_pool = None
+        self.budgets = dict(self.config_bde.get('budgets', {}))
+        self.budget_action = self.budgets.pop('on_exceed', self.BUDGET_WARN)
+        if self.budget_action not in (self.BUDGET_WARN, self.BUDGET_FAIL):
+            raise exc.ConfigError("Unknown bde.budgets.on_exceed: %s" % self.budget_action)
+        # table -> revision table name, or None to use the function
+        self._revision_tables = {}
+
+        # processors for the extra Koordinates targets, sharing our BDE database access
+        self.targets = {}
+        for name, target_config in sorted(config.targets.items()):
+            target_bde = BDEProcessor(target_config, target=name)
+            target_bde.db = self.db
+            target_bde.bde_counts = self.bde_counts
+            target_bde._counts_inflight = self._counts_inflight
+            target_bde._counts_lock = self._counts_lock
+            target_bde._revision_tables = self._revision_tables
+            self.targets[name] = target_bde
+
+        if self.verify == self.VERIFY_CHECKSUM and not target:
+            self.start_checksum_pool()
+
+    def start_checksum_pool(self):
+        """
+        Start the worker processes for content checksums (shared with the
+        extra targets), if bde.checksum.processes is more than 1. Call from
+        the main thread, before any BDE queries or Koordinates requests.
+        """
+        if self._checksum_pool is None and self.checksum_processes > 1:
+            self._checksum_pool = checksum.create_pool(self.checksum_processes)
+            for target_bde in self.targets.values():
+                target_bde._checksum_pool = self._checksum_pool
 
-    def _db(self):
-        """ Get a Postgres Connection """
-        if not hasattr(self, "_db_conn"):
-            self._db_conn = psycopg2.connect(**self.config_bde['database'])
-        return self._db_conn
+    def each_target(self, job, func, create=True):
+        """
+        Call func(bde, job) for our Koordinates site and each extra target
+        (with their processor & Job) in parallel. Without create, only targets
+        the Job already has are included.
+        Errors are raised once they've all finished.
+        """
+        existing = dict((j.target_name, j) for j in job.with_targets() if j.target_name)
+        items = [(self, job)]
+        for name in sorted(self.targets):
+            target_job = job.target(name) if create else existing.get(name)
+            if target_job is not None:
+                items.append((self.targets[name], target_job))
+        results = parallel_map(lambda item: func(*item), items, len(items))
+        for (bde, target_job), result, e in results:
+            if e is not None:
+                self.log.error("Job %s: %s: %s", job.id, bde.target or self.config_api['endpoint'], e)
+        for _, result, e in results:
+            if e is not None:
+                raise e
+        return [result for _, result, e in results]
+
+    def own_job(self, job):
+        """ The Job for this processor's site: job itself, or its Job for our target """
+        return job.target(self.target) if self.target else job
+
+    def is_finished(self, job):
+        """ Whether a Job (and its extra targets) are in terminal states """
+        return all(j.state in Job.TERMINAL_STATES for j in job.with_targets())
 
-    def _dbcursor(self):
-        """ Get a psycopg2 DictCursor """
-        return self._db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    def validate_config(self, tables, groups):
+        """ Validate that layers/tables/groups listed in the BDE config file are sane """
+        CompiledConfig.validate_bde(tables, groups)
+
+    def close(self):
+        """ Save the caches, and close the BDE database connections & checksum processes """
+        self.flush_caches()
+        self.db.close()
+        if self._checksum_pool is not None:
+            self._checksum_pool.terminate()
+            self._checksum_pool.join()
+            self._checksum_pool = None
+            for target_bde in self.targets.values():
+                target_bde._checksum_pool = None
+
+    def flush_caches(self):
+        """ Save any changes to our (and the extra targets') cache files """
+        for bde in [self] + [t for n, t in sorted(self.targets.items())]:
+            for cache in (bde.version_cache, bde.import_history, bde.bde_counts):
+                try:
+                    cache.flush()
+                except (IOError, OSError) as e:
+                    self.log.warn("Couldn't save cache %s: %s", cache.path, e)
+
+    def log_metrics(self):
+        """ Log a summary of the Koordinates API calls & BDE queries made """
+        for line in self.koordinates_client.metrics.summary():
+            self.log.info("API %s", line)
+        for name, target_bde in sorted(self.targets.items()):
+            target_bde.log_metrics()
+        if not self.target:
+            # targets share our database
+            for line in self.db.metrics.summary():
+                self.log.info("DB %s", line)
+
+    def call_counts(self):
+        """
+        Calls made so far, including the extra targets': {'api': total API requests,
+        'db': total BDE statements, endpoint or query type: calls}
+        """
+        counts = defaultdict(int)
+        for bde in [self] + [t for n, t in sorted(self.targets.items())]:
+            for endpoint, calls in bde.koordinates_client.metrics.counts().items():
+                counts['api'] += calls
+                counts[endpoint] += calls
+        for kind, calls in self.db.metrics.counts().items():
+            counts['db'] += calls
+            counts[kind] += calls
+        return dict(counts)
+
+    def check_budget(self, command):
+        """
+        Compare the calls made against bde.budgets[command], logging any
+        overruns. Returns a list of overrun messages.
+        """
+        budget = self.budgets.get(command) or {}
+        counts = self.call_counts()
+        overruns = []
+        for key, limit in sorted(budget.items()):
+            calls = counts.get(key, 0)
+            if calls > limit:
+                overruns.append("%s: %s made %d calls, budget is %d" % (command, key, calls, limit))
+        for message in overruns:
+            self.log.warn("Over budget: %s", message)
+        return overruns
 
     def get_upload(self, id):
         """
         Get an Upload by ID.
         Raises NotFound if the Upload doesn't exist.
         """
-        cur = self._dbcursor()
-        cur.execute("SELECT * FROM bde_control.upload WHERE id=%s", (id,))
-        data = cur.fetchone()
+        data = self.db.fetchone("SELECT * FROM bde_control.upload WHERE id=%s", (id,), prepare=True)
 
         if not data:
             raise Upload.NotFound("Upload %s not found" % id)
 
         return Upload(**data)
 
+    def get_uploads(self, ids):
+        """
+        Get several Uploads by ID with one query.
+        Returns a dict of {id: Upload}, missing Uploads aren't included.
+        """
+        if not ids:
+            return {}
+        rows = self.db.fetchall("SELECT * FROM bde_control.upload WHERE id = ANY(%s)", (list(ids),), prepare=True)
+        return dict((row['id'], Upload(**row)) for row in rows)
+
     def get_active_upload(self):
         """
         Get the in-progress Upload, or None.
         """
-        cur = self._dbcursor()
-        cur.execute("SELECT * FROM bde_control.upload WHERE status='%s' ORDER BY id DESC LIMIT 1", (Upload.STATUS_ACTIVE,))
-        data = cur.fetchone()
+        data = self.db.fetchone("SELECT * FROM bde_control.upload WHERE status=%s ORDER BY id DESC LIMIT 1", (Upload.STATUS_ACTIVE,), prepare=True)
 
         if data:
             return Upload(**data)
@@ -154,49 +369,263 @@ class BDEProcessor(object):
         """
         Get the most recent (possibly in-progress) Upload, or None.
         """
-        cur = self._dbcursor()
-        cur.execute("SELECT * FROM bde_control.upload ORDER BY id DESC LIMIT 1")
-        data = cur.fetchone()
+        data = self.db.fetchone("SELECT * FROM bde_control.upload ORDER BY id DESC LIMIT 1", prepare=True)
 
         if data:
             return Upload(**data)
         else:
             return None
 
-    def get_bde_row_count(self, table, rev):
+    def get_bde_row_count(self, table, rev, strategy=None):
         """
         Get the row count for the specified BDE table at the specified BDE revision.
+
+        strategy defaults to bde.row_count. COUNT_REVISION_TABLE counts directly
+        from the table_version revision table, falling back to COUNT_FUNCTION
+        (materializing ver_get_*_revision()) if the table doesn't have one.
         """
-        cur = self._dbcursor()
+        sql, params = self._row_count_sql(table, rev, strategy)
+        return self.db.fetchone("SELECT %s AS count" % sql, params, prepare=True, dict_rows=False)[0] or 0
+
+    def _row_count_sql(self, table, rev, strategy=None):
+        """ Returns a (sql, params) tuple for a scalar row count expression """
+        strategy = strategy or self.row_count
+        if strategy == self.COUNT_REVISION_TABLE:
+            revision_table = self._revision_table(table)
+            if revision_table:
+                # Rows live at rev were created at or before rev and not expired by then.
+                # Every expired row was created before it expired, so this is two range
+                # counts the _revision_created/_revision_expired indexes can answer.
+                sql = (
+                    "((SELECT COUNT(*) FROM %(t)s WHERE _revision_created <= %%s)"
+                    " - (SELECT COUNT(*) FROM %(t)s WHERE _revision_expired <= %%s))"
+                ) % {'t': revision_table}
+                return sql, [rev, rev]
+
         schema_name, table_name = table.split('.')
-        sql = "SELECT COUNT(*) AS count from table_version.ver_get_%s_%s_revision(%%s)" % (schema_name, table_name)
-        cur.execute(sql, (rev,))
-        return cur.fetchone()['count'] or 0
+        sql = "(SELECT COUNT(*) FROM table_version.ver_get_%s_%s_revision(%%s))" % (schema_name, table_name)
+        return sql, [rev]
+
+    def _revision_table(self, table):
+        """
+        Find the quoted name of the table_version revision table for a BDE table,
+        or None if there isn't a usable one.
+        """
+        if table not in self._revision_tables:
+            schema_name, table_name = table.split('.')
+            row = self.db.fetchone("""
+                SELECT quote_ident(n.nspname) || '.' || quote_ident(c.relname) AS name
+                FROM pg_catalog.pg_class c
+                    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = 'table_version' AND c.relname = %s
+                    AND (SELECT COUNT(*) FROM pg_catalog.pg_attribute a
+                         WHERE a.attrelid = c.oid AND NOT a.attisdropped
+                            AND a.attname IN ('_revision_created', '_revision_expired')) = 2
+            """, ('%s_%s_revision' % (schema_name, table_name),))
+            if not row:
+                self.log.warn("No table_version revision table for %s, counting rows via ver_get_%s_%s_revision()", table, schema_name, table_name)
+            self._revision_tables[table] = row['name'] if row else None
+        return self._revision_tables[table]
+
+    def get_bde_revision(self):
+        """ Get the latest table_version revision """
+        return self.db.fetchone("SELECT table_version.ver_get_last_revision() AS rev")['rev']
 
     def get_bde_change_counts(self, table, rev_from, rev_to):
         """
         Get a tuple (INSERTs, UPDATEs, DELETEs) of change counts
         for the specified BDE table between the two specified BDE revisions.
         """
-        cur = self._dbcursor()
+        sql, params = self._change_counts_sql(table, rev_from, rev_to)
+        return self._change_counts(self.db.fetchall(sql, params, prepare=True, dict_rows=False))
+
+    def _change_counts_sql(self, table, rev_from, rev_to):
+        """ Returns a (sql, params) tuple for a query of (action, count) rows """
         schema_name, table_name = table.split('.')
         sql = "SELECT _diff_action AS action, COUNT(*) AS count from table_version.ver_get_%s_%s_diff(%%s, %%s) GROUP BY _diff_action" % (schema_name, table_name)
-        cur.execute(sql, (rev_from, rev_to))
+        return sql, [rev_from, rev_to]
 
+    @staticmethod
+    def _change_counts(rows):
         counts = {
             'I': 0,
             'U': 0,
             'D': 0,
         }
-        for row in cur.fetchall():
-            counts[row['action']] = row['count']
+        for action, count in rows:
+            counts[action] = count
 
         return (counts['I'], counts['U'], counts['D'])
 
-    def update_job(self, job, job_state=None, verify=VERIFY_ALL):
+    def get_bde_counts_batch(self, requests):
+        """
+        Get BDE row & change counts for many tables with few round trips.
+
+        requests is a list of (table, rev, rev_from) tuples; rev_from may be
+        None to skip the change counts. Up to bde.verify_batch_size tables are
+        combined into each UNION ALL statement, which is cancelled if it runs
+        longer than bde.verify_timeout seconds per table, or past any enclosing
+        dbwait.deadline().
+
+        Counts are cached (see bde_counts), so other targets verifying the same
+        tables & revisions don't re-run them. If another target is already
+        counting a table we wait for its result rather than running the same
+        query concurrently.
+
+        Returns a list in the same order as requests, of (row_count, change_counts)
+        tuples where change_counts is (INSERTs, UPDATEs, DELETEs) or None.
+        If a statement fails its items are the exception instead: a
+        dbwait.QueryTimeout if it was cancelled for taking too long, otherwise
+        BDEUnavailable. Neither is a problem with the data, both are worth retrying.
+        """
+        results = [None] * len(requests)
+        todo = []
+        waiting = []  # (n, in-flight entry) being counted by someone else
+        with self._counts_lock:
+            for n, request in enumerate(requests):
+                key = self._counts_key(*request)
+                cached = self.bde_counts.get(key)
+                if cached is not None:
+                    row_count, changes = cached
+                    results[n] = (row_count, tuple(changes) if changes is not None else None)
+                elif key in self._counts_inflight:
+                    waiting.append((n, self._counts_inflight[key]))
+                else:
+                    self._counts_inflight[key] = {'done': threading.Event(), 'result': None}
+                    todo.append(n)
+
+        try:
+            self._count_bde_batch(requests, todo, results)
+        finally:
+            with self._counts_lock:
+                for n in todo:
+                    key = self._counts_key(*requests[n])
+                    entry = self._counts_inflight.pop(key, None)
+                    if entry is not None:
+                        entry['result'] = results[n] or BDEUnavailable("BDE count query for %s failed" % requests[n][0])
+                        entry['done'].set()
+
+        for n, entry in waiting:
+            # wait in short steps so signals are still handled
+            while not entry['done'].wait(1):
+                pass
+            results[n] = entry['result']
+        return results
+
+    def _count_bde_batch(self, requests, todo, results):
+        """
+        Query the counts for requests[n] for each n in todo, storing them
+        (or the exception) into results[n]. See get_bde_counts_batch().
+        """
+        for offset in range(0, len(todo), self.verify_batch_size):
+            chunk_idx = todo[offset:offset + self.verify_batch_size]
+            chunk = [requests[n] for n in chunk_idx]
+            parts = []
+            params = []
+            for i, (table, rev, rev_from) in enumerate(chunk):
+                sql, sql_params = self._row_count_sql(table, rev)
+                parts.append("SELECT %d AS idx, NULL::text AS action, %s AS count" % (i, sql))
+                params += sql_params
+                if rev_from is not None:
+                    sql, sql_params = self._change_counts_sql(table, rev_from, rev)
+                    parts.append("SELECT %d AS idx, action, count FROM (%s) AS c%d" % (i, sql, i))
+                    params += sql_params
+
+            try:
+                rows = self._execute_with_timeout(" UNION ALL ".join(parts), params, self.verify_timeout * len(chunk))
+            except (dbwait.QueryTimeout, psycopg2.extensions.QueryCanceledError) as e:
+                self.log.error("BDE count query for %s timed out: %s", ", ".join(r[0] for r in chunk), e)
+                for n in chunk_idx:
+                    results[n] = dbwait.QueryTimeout(str(e).strip())
+                continue
+            except psycopg2.Error as e:
+                # eg. lost connections, pool exhaustion, serialization failures
+                self.log.error("BDE count query for %s failed: %s", ", ".join(r[0] for r in chunk), e)
+                for n in chunk_idx:
+                    results[n] = BDEUnavailable(str(e).strip())
+                continue
+
+            by_idx = defaultdict(list)
+            for idx, action, count in rows:
+                by_idx[idx].append((action, count))
+            for i, (table, rev, rev_from) in enumerate(chunk):
+                row_count = sum(count or 0 for action, count in by_idx[i] if action is None)
+                changes = None
+                if rev_from is not None:
+                    changes = self._change_counts([(a, c) for a, c in by_idx[i] if a is not None])
+                results[chunk_idx[i]] = (row_count, changes)
+                self.bde_counts.set(self._counts_key(table, rev, rev_from), [row_count, changes])
+
+    @staticmethod
+    def _counts_key(table, rev, rev_from):
+        return "%s:%s:%s" % (table, rev, rev_from)
+
+    def _execute_with_timeout(self, sql, params, timeout):
+        """
+        Run a query in its own read-only transaction, cancelling it after timeout seconds
+        (or the enclosing dbwait.deadline()) both client-side and via statement_timeout.
+        Returns all the rows as tuples. Raises dbwait.QueryTimeout if it was cancelled.
+        The query isn't prepared: batches are one-offs.
+        """
+        with dbwait.deadline(timeout):
+            remaining = dbwait.remaining()
+            if remaining is not None and remaining < 1:
+                raise dbwait.QueryTimeout("No time left to run query")
+
+            with self.db.connection() as conn:
+                cur = self.db.cursor(conn, dict_rows=False)
+                self.db.execute(cur, "SET TRANSACTION READ ONLY")
+                if remaining is not None:
+                    self.db.execute(cur, "SET LOCAL statement_timeout = %s", (int(remaining * 1000),))
+                return self.db.execute(cur, sql, params).fetchall()
+
+    def monitor_jobs(self, jobs):
+        """
+        Check and progress several Jobs concurrently (up to bde.monitor_workers at once),
+        including their extra Koordinates targets.
+        Jobs in terminal states are skipped, and the Uploads for the rest are
+        fetched with a single query.
+        Returns a list of (job, exception) tuples for the jobs that were checked.
+        """
+        active = []
+        for job in jobs:
+            if self.is_finished(job):
+                self.log.debug("Job %s: %s, not checking", job.id, job.state)
+            else:
+                active.append(job)
+
+        uploads = self.get_uploads([job.id for job in active])
+
+        def update(job):
+            upload = uploads.get(job.id)
+            self.each_target(job, lambda bde, job: bde.update_job(job, upload=upload), create=False)
+
+        return [(job, e) for (job, _, e) in parallel_map(update, active, self.monitor_workers)]
+
+    def update_job(self, job, job_state=None, verify=None, pipeline=None, upload=None):
+        """
+        Check and progress a Job.
+        With pipeline (defaults to bde.pipeline_verification) layers are verified
+        as soon as their imports complete, rather than when the publish is ready.
+        upload is the job's Upload if it's already been fetched.
+
+        verify (default bde.verify) is the verification level before
+        publishes are approved. With VERIFY_TWO_PHASE they're approved once the
+        feature counts match, and the change counts are verified on a later
+        pass (retrying until it can finish); the Job isn't complete until
+        that's passed.
+        """
         timestamp = timestamp_local()
-        upload = self.get_upload(job.id)
-        job.bde_upload = upload.serialize()
+        if pipeline is None:
+            pipeline = self.pipeline_verification
+        verify = verify or self.verify
+        two_phase = (verify == self.VERIFY_TWO_PHASE)
+        if two_phase:
+            verify = self.VERIFY_COUNTS
+        if upload is None:
+            upload = self.get_upload(job.id)
+        if job.bde_upload.get('status') != upload.status:
+            job.bde_upload = upload.serialize()
         self.log.info("Job %s", job.id)
 
         job_state = job_state or job.state
@@ -219,40 +648,109 @@ class BDEProcessor(object):
             if prev_state != job.state:
                 self.notify.info("Job %s: %s -> %s", job.id, prev_state, job.state)
 
+            if job.state == Job.STATE_BDE_RUNNING and self.prestage:
+                self.prestage_update(job)
+
         if job_state == Job.STATE_IMPORTING:
             # Check on state of publish groups
             counts = defaultdict(int)
             num_groups = len(job.groups)
+            for name, group in sorted(job.groups.items()):
+                if group.get('publish_state') == 'waiting-for-items':
+                    self.log.info("Job %s: Checking layer imports for group: %s", job.id, name)
+                    failed = self._update_layer_imports(job, name, group, verify=(verify if pipeline else None))
+                    if failed:
+                        self._import_errors(job, name, group, failed)
+
+            approvals = {}
             for name, group in job.groups.items():
+                if group.get('superseded_by'):
+                    counts['superseded'] += 1
+                elif not group.get('publish_id'):
+                    self.log.warn("Job %s: Group %s: No publish (%s)", job.id, name, group.get('error'))
+                    counts['not-started'] += 1
+
+            for name, (result, error) in sorted(self.refresh_publishes(job).items()):
+                group = job.groups[name]
                 self.log.info("Job %s: Updating Publish group: %s", job.id, name)
-                publish = self.koordinates_client.publishing.get(group['publish_id'])
+                if error:
+                    if self.debug:
+                        raise error
+                    self.log.error("Job %s: Group %s: Error checking Publish %s: %s", job.id, name, group['publish_id'], error)
+                    counts[group['publish_state']] += 1
+                    continue
+
+                publish, validators = result
+                if publish is None or (publish.state == group.get('publish_state') and publish.state != 'waiting-for-approval'):
+                    # unchanged since the last check
+                    self.log.info("Job %s: Group %s: unchanged (%s)", job.id, name, group['publish_state'])
+                    counts[group['publish_state']] += 1
+                    continue
 
                 if publish.state == 'waiting-for-approval':
-                    do_pub = False
                     if verify == self.VERIFY_NONE:
                         self.log.info("Job %s: Group %s: Skipping BDE consistency check", job.id, name)
-                        do_pub = True
                     else:
                         # QA Time
                         try:
-                            self.verify_job(job, group, count_only=(verify == self.VERIFY_COUNTS))
-                            do_pub = True
+                            self.verify_job(job, group, level=verify)
+                        except VerificationDeferred as e:
+                            # leave it waiting-for-approval and try again next time
+                            self.log.warn("Job %s: Group %s: %s", job.id, name, e)
+                            counts['verification-timeout'] += 1
+                            continue
                         except ConsistencyError as e:
                             self.log.warn("Job %s: Group %s: BDE Consistency Errors: %s", job.id, name, e.args)
                             job.state = Job.STATE_ERRORS
                             error_message = "\n".join(["Group %s: BDE Consistency Errors" % name] + map(str, e.args))
                             self.notify.error("Job %s:\n%s", job.id, error_message)
                             continue
+                        except Exception as e:
+                            # eg. a Koordinates API error. Don't hold up the other groups, try again next time
+                            if self.debug:
+                                raise
+                            self.log.error("Job %s: Group %s: Error verifying: %s", job.id, name, e)
+                            if group.get('verification_error') != str(e):
+                                self.notify.error("Job %s: Group %s: Error verifying, will retry: %s", job.id, name, e)
+                            group['verification_error'] = str(e)
+                            counts['verification-error'] += 1
+                            continue
+                        group.pop('verification_error', None)
+                    approvals[name] = publish
+                    continue
+
+                self._set_publish_state(group, publish, validators, timestamp)
+                counts[publish.state] += 1
 
-                    if do_pub:
-                        self._publish_approve(publish)
-                        publish = self.koordinates_client.publishing.get(publish.id)
-                        self.notify.info("Job %s: Group %s: BDE consistency check passed - publishing now", job.id, name, extra={'color':'good'})
+            # approve everything that passed verification
+            approved = set()
+            for name, (publish, error) in sorted(self.approve_publishes(approvals).items()):
+                group = job.groups[name]
+                if error:
+                    if self.debug:
+                        raise error
+                    self.log.error("Job %s: Group %s: Error approving Publish %s: %s", job.id, name, group['publish_id'], error)
+                    self.notify.error("Job %s: Group %s: Error approving Publish: %s", job.id, name, error)
+                    counts[group['publish_state']] += 1
+                    continue
 
-                group['publish_state'] = publish.state
-                group['last_update'] = timestamp
+                self.notify.info("Job %s: Group %s: BDE consistency check passed - publishing now", job.id, name, extra={'color':'good'})
+                self._set_publish_state(group, publish, None, timestamp)
+                if two_phase:
+                    group['post_publish_verification'] = {'state': self.POST_VERIFY_PENDING}
+                    approved.add(name)
                 counts[publish.state] += 1
 
+            # second phase of two-phase verification, the data's on its way to users already.
+            # Groups approved in this pass wait for the next one, so approvals aren't held up.
+            post_verify = {}
+            for name, group in sorted(job.groups.items()):
+                state = group.get('post_publish_verification', {}).get('state')
+                if state == self.POST_VERIFY_PENDING and name not in approved and group.get('publish_state') in ('publishing', 'completed'):
+                    state = self._post_publish_verify(job, name, group)
+                if state:
+                    post_verify[name] = state
+
             self.log.info("Job %s: Publish Group State Counts: (/%d) %s", job.id, num_groups, dict(counts))
             # Possible publish states:
             #       waiting-for-time
@@ -264,9 +762,22 @@ class BDEProcessor(object):
             #       errored
             #       completed
 
-            if counts['cancelled'] + counts['cancelled-due-to-error'] + counts['errored'] + counts['completed'] == num_groups:
+            if counts['cancelled'] + counts['cancelled-due-to-error'] + counts['errored'] + counts['completed'] + counts['superseded'] == num_groups:
                 # they're all done in some way or another
-                if counts['completed'] == num_groups:
+                if counts['superseded'] and counts['completed'] + counts['superseded'] == num_groups:
+                    self.log.info("Job %s: All Publishes complete or superseded by Job %s", job.id, job.superseded_by)
+                    job.state = Job.STATE_SUPERSEDED
+                    self.notify.info("Job %s: Publishes complete, remainder superseded by Job %s", job.id, job.superseded_by)
+                elif counts['completed'] == num_groups and self.POST_VERIFY_PENDING in post_verify.values():
+                    # stay importing until the second phase has finished
+                    self.log.info("Job %s: All Publishes complete, post-publish verification pending for: %s", job.id,
+                        ", ".join(n for n, s in sorted(post_verify.items()) if s == self.POST_VERIFY_PENDING))
+                elif counts['completed'] == num_groups and self.POST_VERIFY_FAILED in post_verify.values():
+                    self.log.warn("Job %s: All Publishes complete, post-publish verification failed", job.id)
+                    job.state = Job.STATE_ERRORS
+                    self.notify.error("Job %s: Publishes complete, but post-publish BDE consistency checks failed for: %s", job.id,
+                        ", ".join(n for n, s in sorted(post_verify.items()) if s == self.POST_VERIFY_FAILED))
+                elif counts['completed'] == num_groups:
                     # all succeeded
                     self.log.info("Job %s: All Publishes complete", job.id)
                     job.state = Job.STATE_COMPLETE
@@ -282,6 +793,197 @@ class BDEProcessor(object):
 
         return job
 
+    def _post_publish_verify(self, job, name, group):
+        """
+        Second phase of VERIFY_TWO_PHASE: fully verify a group which was
+        approved on feature counts. The result is recorded in
+        group['post_publish_verification'], and mismatches are notified.
+        Returns the new state, still POST_VERIFY_PENDING if it couldn't finish
+        (timeouts or BDE database errors) so it's retried next time.
+        """
+        self.log.info("Job %s: Group %s: Post-publish verification", job.id, name)
+        result = group['post_publish_verification']
+        try:
+            self.verify_job(job, group, level=self.VERIFY_ALL)
+        except VerificationDeferred as e:
+            # try again next time
+            self.log.warn("Job %s: Group %s: %s", job.id, name, e)
+            return result['state']
+        except ConsistencyError as e:
+            # verify_job() raises with a list of the per-layer errors
+            errors = e.args[0] if e.args and isinstance(e.args[0], list) else e.args
+            error_message = "\n".join(map(str, errors))
+            result.update({
+                'state': self.POST_VERIFY_FAILED,
+                'error': error_message,
+            })
+            self.log.warn("Job %s: Group %s: Post-publish BDE Consistency Errors: %s", job.id, name, e.args)
+            self.notify.error("Job %s:\nGroup %s: Post-publish BDE Consistency Errors, the published data needs checking\n%s", job.id, name, error_message)
+        except Exception as e:
+            # eg. a Koordinates API error, try again next time
+            if self.debug:
+                raise
+            self.log.error("Job %s: Group %s: Error in post-publish verification: %s", job.id, name, e)
+            result['error'] = str(e)
+            return result['state']
+        else:
+            result['state'] = self.POST_VERIFY_PASSED
+            result.pop('error', None)
+            self.notify.info("Job %s: Group %s: Post-publish BDE consistency check passed", job.id, name, extra={'color': 'good'})
+        result['verified_at'] = timestamp_local()
+        return result['state']
+
+    def _update_layer_imports(self, job, group_name, group, verify=None):
+        """
+        Check the import state of each layer version in a group that hasn't
+        finished importing yet, recording import durations as they complete.
+        If verify is set, completed layers are verified at that level.
+        Returns a list of layer IDs whose imports have newly failed.
+        """
+        failed = []
+        layers = group.setdefault('layers', {})
+        for layer_id, version_id in sorted(group.get('layer_versions', {}).items()):
+            layer_state = layers.setdefault(layer_id, {})
+            if layer_state.get('import_state') not in (self.IMPORT_OK, self.IMPORT_ERROR):
+                version = self.koordinates_client.layers.get_version(layer_id, version_id)
+                status = version.version.status
+                if status != layer_state.get('import_state'):
+                    self.log.info("Job %s: Group %s: Layer %s import state: %s", job.id, group_name, layer_id, status)
+                    layer_state['import_state'] = status
+                    if status == self.IMPORT_OK and layer_state.get('import_started_at'):
+                        duration = elapsed_seconds(layer_state['import_started_at'])
+                        layer_state['import_duration'] = duration
+                        self._record_import_duration(layer_id, duration)
+                    elif status == self.IMPORT_ERROR:
+                        failed.append(layer_id)
+
+            if verify and verify != self.VERIFY_NONE and layer_state.get('import_state') == self.IMPORT_OK:
+                if not self._verification_covers(layer_state.get('verification'), verify):
+                    try:
+                        self._verify_layer(job, layer_id, version_id, layer_state, verify)
+                    except KoordinatesStateError as e:
+                        # try again when the publish is ready
+                        self.log.warn("Job %s: Group %s: Layer %s: can't verify yet: %s", job.id, group_name, layer_id, e)
+
+        return failed
+
+    def _import_errors(self, job, group_name, group, layer_ids):
+        """
+        Handle failed layer imports in a publish group.
+        If bde.cancel_on_import_error is set the publish is cancelled now, rather
+        than waiting for the other imports in the group to finish.
+        """
+        job.has_import_errors = True
+        group['import_errors'] = sorted(set(group.get('import_errors', []) + layer_ids))
+        self.log.warn("Job %s: Group %s: Layer import errors: %s", job.id, group_name, layer_ids)
+        self.notify.error("Job %s: Group %s: Import errors for layers: %s", job.id, group_name, ", ".join(map(str, layer_ids)))
+
+        if self.cancel_on_import_error:
+            publish = self.koordinates_client.publishing.get(group['publish_id'])
+            try:
+                self.log.info("Cancelling Publish %s", publish.id)
+                publish.cancel()
+            except koordinates.Conflict as e:
+                if self.debug:
+                    raise
+                self.log.error("Conflict error cancelling Publish %s: %s", publish.id, e)
+
+    def _record_import_duration(self, layer_id, duration):
+        """ Update the moving average import duration for a layer """
+        previous = self.import_history.get(str(layer_id))
+        if previous is not None:
+            duration = (previous + duration) / 2.0
+        self.import_history.set(str(layer_id), duration)
+
+    def _estimated_duration(self, layer_ids):
+        """
+        Estimated total import duration (seconds) for some layers, based on
+        previous imports. Layers without history are assumed to be as slow as
+        the slowest known one.
+        """
+        known = dict((layer_id, self.import_history.get(str(layer_id))) for layer_id in layer_ids)
+        slowest = max([d for d in known.values() if d is not None] or [0])
+        return sum((slowest if d is None else d) for d in known.values())
+
+    def _ordered_groups(self):
+        """ Configured publish groups, in the order to start them """
+        groups = list(self.config.groups)
+        if self.start_order == self.ORDER_LONGEST_FIRST:
+            # longest-processing-time first. sort is stable, so ties keep config order
+            groups.sort(key=lambda g: self._estimated_duration(g['layers']), reverse=True)
+        return groups
+
+    def _ordered_layers(self, layer_ids):
+        """ Layers of a publish group, in the order to start them """
+        layer_ids = list(layer_ids)
+        if self.start_order == self.ORDER_LONGEST_FIRST:
+            layer_ids.sort(key=lambda l: self._estimated_duration([l]), reverse=True)
+        return layer_ids
+
+    def _set_publish_state(self, group, publish, validators, timestamp):
+        group['publish_state'] = publish.state
+        group['publish_validators'] = validators
+        group['last_update'] = timestamp
+
+    def _concurrently(self, func, items):
+        """
+        Call func((name, value)) for each item of the items dict, across up to bde.workers threads.
+        Returns a dict of name -> (result, exception).
+        """
+        results = parallel_map(func, sorted(items.items()), self.workers)
+        return dict((name, (result, error)) for ((name, _), result, error) in results)
+
+    def refresh_publishes(self, job):
+        """
+        Conditionally GET the Publish for each started group of a job, concurrently.
+        Returns a dict of group name -> ((publish, validators), exception). See api.Client.get_publish()
+        """
+        def refresh(item):
+            name, group = item
+            # approvals need a full Publish object, don't ask for a 304
+            validators = None
+            if group.get('publish_state') != 'waiting-for-approval':
+                validators = group.get('publish_validators')
+            return self.koordinates_client.get_publish(group['publish_id'], validators)
+
+        groups = dict((name, group) for name, group in job.groups.items() if group.get('publish_id') and not group.get('superseded_by'))
+        return self._concurrently(refresh, groups)
+
+    def approve_publishes(self, publishes):
+        """
+        Approve Publishes concurrently. publishes is a dict of group name -> Publish.
+        Returns a dict of group name -> (refreshed publish, exception).
+        """
+        def approve(item):
+            name, publish = item
+            self._publish_approve(publish)
+            return self.koordinates_client.publishing.get(publish.id)
+
+        return self._concurrently(approve, publishes)
+
+    def cancel_publishes(self, job):
+        """
+        Cancel the Publish for each started group of a job, concurrently.
+        Groups without a Publish are logged and skipped.
+        Returns a dict of group name -> (publish ID, exception).
+        """
+        def cancel(item):
+            name, group = item
+            publish = self.koordinates_client.publishing.get(group['publish_id'])
+            self.log.info("Cancelling Publish %s", publish.id)
+            publish.cancel()
+            return publish.id
+
+        groups = dict((name, group) for name, group in job.groups.items() if group.get('publish_id'))
+        for name in self._unpublished_groups(job):
+            self.log.warn("Job %s: Group %s: No publish to cancel (%s)", job.id, name, job.groups[name].get('error') or 'not started')
+        return self._concurrently(cancel, groups)
+
+    @staticmethod
+    def _unpublished_groups(job):
+        """ Names of the groups of a job which have no Publish """
+        return sorted(name for name, group in job.groups.items() if not group.get('publish_id'))
+
     def _publish_approve(self, publish):
         # TODO: add to koordinates library
         target_url = publish._client.get_url('PUBLISH', 'GET', 'single', {'id': publish.id}) + 'approve/'
@@ -299,17 +1001,14 @@ class BDEProcessor(object):
         return ref
 
     def check_schedule(self, schedule):
-        if schedule == "*" or schedule == True or schedule is None:
-            return True
-        elif not schedule:  # False
-            return False
-
-        today = datetime.date.today()
-        rule = dateutil.rrule.rrulestr(schedule, dtstart=today)
-        return rule[0].date() == today
+        return self.config.schedule_matches(schedule)
 
-    def start_update(self, job, check_bde_state=True, ignore_schedule=False):
-        """ Begin updating the entire set of layers """
+    def start_update(self, job, check_bde_state=True, ignore_schedule=False, older_jobs=None):
+        """
+        Begin updating the entire set of layers.
+        If bde.coalesce is set, pending work in older_jobs is superseded for the
+        groups this job has successfully created publishes for.
+        """
         self.log.info("Job %s: start_update", job.id)
         first = True
 
@@ -327,25 +1026,22 @@ class BDEProcessor(object):
         job.bde_upload = upload.serialize()
         job.save()
 
+        groups = [g for g in self._ordered_groups() if self._is_scheduled(g, ignore_schedule)]
+
         # iterate through each publish group
         job.groups = job.groups or {}
         errors = {}
-        for group in self.config_bde['groups']:
-            # check group validity
-            schedule = group.get('schedule', None)
-            if not self.check_schedule(schedule):
-                if ignore_schedule or self.debug:
-                    self.log.warn("Ignoring schedule (%s) and importing anyway...", schedule)
-                else:
-                    self.log.info("Schedule (%s) doesn't match, not starting imports.", schedule)
-                    continue
+        for group in groups:
+            group_name = group['name']
+            if job.groups.get(group_name, {}).get('superseded_by'):
+                self.log.info("Job %s: group %s superseded by Job %s, skipping", job.id, group_name, job.groups[group_name]['superseded_by'])
+                continue
 
             if first:
                 self.notify.info("Job %s: Starting LDS update...", job.id)
                 first = False
 
             # wrap each group in a try-except - groups are independent
-            group_name = group['name']
             try:
                 self._start_group(job, group)
             except Exception as e:
@@ -355,11 +1051,17 @@ class BDEProcessor(object):
                 errors[group_name] = e
                 job.save()
 
+        if self.coalesce and older_jobs:
+            # only once we're sure to publish the changes ourselves
+            started = [g['name'] for g in groups if job.groups.get(g['name'], {}).get('publish_id') and g['name'] not in errors]
+            if started:
+                self.supersede_jobs(job, older_jobs, started)
+
         if job.groups or errors:
             job.state = Job.STATE_IMPORTING
 
             if errors:
-                if len(errors) == len(self.config_bde['groups']):
+                if len(errors) == len(self.config.groups):
                     self.log.error("Job %s: Errors creating ALL LDS update groups: %s", job.id, errors)
                     job.state = Job.STATE_ERRORS
                     job.save()
@@ -371,6 +1073,240 @@ class BDEProcessor(object):
         job.save()
         return job
 
+    def prestage_update(self, job, ignore_schedule=False):
+        """
+        Create (or reuse) draft versions tagged with the job reference for each
+        scheduled layer, without starting any imports. Run while the BDE upload
+        is still in progress, so start_update() only needs to start the imports
+        and create the publishes. Errors are logged, the layers get staged as
+        normal by start_update().
+
+        Layers are recorded as staged (with version None) before their drafts
+        get tagged, so if we die part-way start_update() still knows the
+        tagged draft has no import running.
+        """
+        ref = self.get_reference(job.id)
+        for group in self._ordered_groups():
+            if not (ignore_schedule or self.debug or self.check_schedule(group.get('schedule', None))):
+                continue
+
+            staged = job.prestaged.setdefault(group['name'], {})
+            for layer_id in self._ordered_layers(group['layers']):
+                if staged.get(layer_id) is not None:
+                    continue
+
+                staged[layer_id] = None
+                job.save()
+                try:
+                    layer, tagged = self._stage_layer(ref, layer_id, take_over=False)
+                except Exception as e:
+                    del staged[layer_id]
+                    job.save()
+                    if self.debug:
+                        raise
+                    self.log.warn("Job %s: Couldn't pre-stage Layer %s: %s", job.id, layer_id, e)
+                    continue
+
+                self.log.info("Job %s: group %s: pre-staged Layer %s version %s", job.id, group['name'], layer_id, layer.version.id)
+                staged[layer_id] = layer.version.id
+                job.save()
+
+    def _is_scheduled(self, group, ignore_schedule=False):
+        """ Whether a publish group should be started today """
+        schedule = group.get('schedule', None)
+        if self.check_schedule(schedule):
+            return True
+        elif ignore_schedule or self.debug:
+            self.log.warn("Ignoring schedule (%s) and importing anyway...", schedule)
+            return True
+        else:
+            self.log.info("Schedule (%s) doesn't match, not starting imports.", schedule)
+            return False
+
+    def supersede_jobs(self, job, older_jobs, group_names):
+        """
+        Coalesce older, still-running Jobs into job, which has started to
+        reimport the groups in group_names with newer BDE data. In the older jobs those
+        groups are marked superseded and their pending publishes are cancelled.
+        Groups already publishing or finished are left alone. Older jobs which
+        haven't started are only superseded outright if group_names covers
+        every group they'd start, otherwise they stay runnable without the
+        covered groups.
+        Returns a list of the older jobs that were modified.
+        """
+        modified = []
+        for older in older_jobs:
+            if older.id >= job.id or older.state not in (Job.STATE_BDE_FINISHED, Job.STATE_IMPORTING):
+                continue
+
+            superseded = []
+            for name in group_names:
+                group = older.groups.get(name)
+                if group is None and older.state == Job.STATE_BDE_FINISHED:
+                    # not started yet, make sure it won't be
+                    group = older.groups.setdefault(name, {})
+                if group is None or group.get('superseded_by'):
+                    continue
+                if group.get('publish_id'):
+                    if group.get('publish_state') not in self.PUBLISH_PENDING:
+                        continue
+                    publish = self.koordinates_client.publishing.get(group['publish_id'])
+                    try:
+                        self.log.info("Job %s: Cancelling superseded Publish %s", older.id, publish.id)
+                        publish.cancel()
+                    except koordinates.Conflict as e:
+                        # probably started publishing
+                        self.log.warn("Job %s: Couldn't cancel Publish %s, leaving it: %s", older.id, publish.id, e)
+                        continue
+                    group['publish_state'] = 'cancelled'
+
+                group['superseded_by'] = job.id
+                superseded.append(name)
+
+            if not superseded:
+                continue
+
+            self.log.info("Job %s: superseded by Job %s for groups: %s", older.id, job.id, superseded)
+            older.superseded_by = job.id
+            if older.state == Job.STATE_BDE_FINISHED:
+                remaining = [g['name'] for g in self._ordered_groups() if self.check_schedule(g.get('schedule', None)) and not older.groups.get(g['name'], {}).get('superseded_by')]
+                if remaining:
+                    self.log.info("Job %s: still to start groups: %s", older.id, remaining)
+                else:
+                    older.state = Job.STATE_SUPERSEDED
+            elif all(g.get('superseded_by') for g in older.groups.values()):
+                older.state = Job.STATE_SUPERSEDED
+            older.save()
+            modified.append(older)
+
+            job.supersedes = sorted(set(job.supersedes + [older.id]))
+            self.notify.info("Job %s: superseded by Job %s (groups: %s)", older.id, job.id, ", ".join(superseded))
+
+        job.save()
+        return modified
+
+    def plan_update(self, job, ignore_schedule=False, lookup=True):
+        """
+        Predict what start_update(job) would do, without changing anything.
+
+        With lookup, each layer to start is fetched (read-only, in parallel)
+        to see whether it has a draft version already. Returns a dict of the
+        groups & layers to start, the API calls and BDE queries expected,
+        and import durations estimated from previous imports.
+        """
+        ref = self.get_reference(job.id)
+        upload = self.get_upload(job.id)
+        plan = {
+            'job': job.id,
+            'target': self.target,
+            'endpoint': self.config_api['endpoint'],
+            'upload_status': upload.status_display,
+            'reference': ref,
+            'groups': [],
+        }
+        api_calls = defaultdict(int)
+        layer_actions = {}
+
+        # which layers need to be looked at
+        todo = []
+        for group in self._ordered_groups():
+            group_state = job.groups.get(group['name'], {})
+            if group_state.get('publish_id') or group_state.get('superseded_by') or not (ignore_schedule or self.check_schedule(group.get('schedule', None))):
+                continue
+            layers_state = group_state.get('layers', {})
+            staged = job.prestaged.get(group['name'], {})
+            for layer_id in group['layers']:
+                progress = layers_state.get(layer_id, {}).get('progress')
+                if progress == self.PROGRESS_IMPORTING:
+                    layer_actions[layer_id] = 'already-importing'
+                elif progress == self.PROGRESS_DRAFT or layer_id in staged:
+                    layer_actions[layer_id] = 'start-staged'
+                elif lookup:
+                    todo.append(layer_id)
+                else:
+                    layer_actions[layer_id] = 'stage-and-start'
+
+        def inspect(layer_id):
+            layer = self.koordinates_client.layers.get(layer_id)
+            if layer.latest_version == layer.published_version:
+                return 'create-draft'
+            elif layer.get_draft_version().supplier_reference == ref:
+                return 'already-tagged'
+            return 'reuse-draft'
+
+        for layer_id, action, e in parallel_map(inspect, todo, self.workers):
+            layer_actions[layer_id] = 'error: %s' % e if e else action
+
+        # calls each action makes: (reads, PUTs, POSTs)
+        costs = {
+            'already-importing': (0, 0, 0),
+            'already-tagged': (2, 0, 0),
+            'start-staged': (0, 0, 1),
+            'create-draft': (1, 0, 2),
+            'reuse-draft': (2, 1, 1),
+            'stage-and-start': (2, 1, 2),  # worst case, not looked up
+        }
+        total_layers = 0
+        verify_statements = 0
+        for group in self._ordered_groups():
+            group_state = job.groups.get(group['name'], {})
+            scheduled = ignore_schedule or self.check_schedule(group.get('schedule', None))
+            group_plan = {
+                'name': group['name'],
+                'schedule': group.get('schedule', None),
+                'scheduled': scheduled,
+                'publish_id': group_state.get('publish_id'),
+                'superseded_by': group_state.get('superseded_by'),
+                'layers': [],
+            }
+            plan['groups'].append(group_plan)
+            if not scheduled or group_state.get('publish_id') or group_state.get('superseded_by'):
+                continue
+
+            durations = []
+            for layer_id in self._ordered_layers(group['layers']):
+                action = layer_actions[layer_id]
+                duration = self.import_history.get(str(layer_id))
+                group_plan['layers'].append({
+                    'id': layer_id,
+                    'table': self.config.layer_tables[layer_id],
+                    'action': action,
+                    'estimated_import_seconds': duration,
+                })
+                reads, puts, posts = costs.get(action, (1, 0, 0))
+                api_calls['GET'] += reads
+                api_calls['PUT'] += puts
+                api_calls['POST'] += posts
+                durations.append(duration)
+                total_layers += 1
+
+            # the publish
+            api_calls['POST'] += 1
+            # verify_job() batches each group's layers separately
+            verify_statements += -(-len(durations) // self.verify_batch_size)
+            known = [d for d in durations if d is not None]
+            group_plan['estimated_import_seconds'] = {
+                # imports run concurrently on the server, so somewhere between these
+                'parallel': max(known) if known else None,
+                'serial': self._estimated_duration(group['layers']) if known else None,
+                'layers_without_history': len(durations) - len(known),
+            }
+
+        # verification once the publishes are ready
+        verify_api = 2 * total_layers
+        plan['api_calls'] = {
+            'start': dict(api_calls),
+            'start_total': sum(api_calls.values()),
+            'verify': verify_api,
+        }
+        plan['db_queries'] = {
+            'verify_statements': verify_statements,
+            'row_count': self.row_count,
+            'ver_get_revision': total_layers if self.row_count == self.COUNT_FUNCTION else 0,
+            'ver_get_diff': total_layers,
+        }
+        return plan
+
     def _start_group(self, job, group):
         """ Begin the update of a single publish group & associated layers """
         group_name = group['name']
@@ -391,17 +1327,73 @@ class BDEProcessor(object):
 
         publish = koordinates.Publish(**publish_kwargs)
 
-        # iterate through each layer to reimport
+        # iterate through each layer to reimport, skipping any already started
         group_state.setdefault('layer_versions', {})
+        layers_state = group_state.setdefault('layers', {})
+        staged = job.prestaged.get(group_name, {})
+        todo = [l for l in self._ordered_layers(group['layers']) if layers_state.get(l, {}).get('progress') != self.PROGRESS_IMPORTING]
         num_layers = len(group['layers'])
-        for i, layer_id in enumerate(group['layers']):
-            self.log.info("layer [%s/%s]: %s", (i + 1), num_layers, layer_id)
-            layer_version = self._start_layer(ref, layer_id)
-            # add the draft version to the publish
+        if len(todo) < num_layers:
+            self.log.info("job %s: group %s: resuming, %d/%d layers already started", job.id, group_name, num_layers - len(todo), num_layers)
+
+        lock = threading.Lock()
+
+        def on_draft(layer):
+            with lock:
+                group_state['layer_versions'][layer.id] = layer.version.id
+                layers_state[layer.id] = {'progress': self.PROGRESS_DRAFT}
+                job.save()
+
+        def start(layer_id):
+            self.log.info("layer [%s/%s]: %s", (todo.index(layer_id) + 1), len(todo), layer_id)
+            layer_version = version_id = None
+            if layers_state.get(layer_id, {}).get('progress') == self.PROGRESS_DRAFT:
+                # draft created for this job already, but the import didn't start
+                version_id = group_state['layer_versions'][layer_id]
+            elif layer_id in staged and layer_id not in group_state['layer_versions']:
+                version_id = staged[layer_id]
+                if version_id is None:
+                    # pre-staging stopped part-way, the draft may be tagged already but isn't importing
+                    layer, _ = self._stage_layer(ref, layer_id)
+                    on_draft(layer)
+                    version_id = layer.version.id
+
+            if version_id is not None:
+                try:
+                    layer_version, started = self._start_staged_layer(layer_id, version_id), True
+                except (koordinates.NotFound, koordinates.Conflict, KoordinatesStateError) as e:
+                    # eg. the draft was deleted or published since, forget it & start again
+                    self.log.warn("Layer %s: can't import draft version %s (%s), staging a new one", layer_id, version_id, e)
+                    with lock:
+                        staged.pop(layer_id, None)
+                        group_state['layer_versions'].pop(layer_id, None)
+                        layers_state.pop(layer_id, None)
+                        job.save()
+
+            if layer_version is None:
+                layer_version, started = self._start_layer(ref, layer_id, on_draft=on_draft)
+
             self.log.info("layer %s: new-version %s", layer_id, layer_version.version.id)
-            group_state['layer_versions'][layer_id] = layer_version.version.id
-            job.save()
-            publish.add_layer_item(layer_version)
+            with lock:
+                group_state['layer_versions'][layer_id] = layer_version.version.id
+                if started:
+                    # a fresh import, forget about any previous one
+                    layers_state[layer_id] = {'import_started_at': timestamp_local()}
+                layers_state.setdefault(layer_id, {})['progress'] = self.PROGRESS_IMPORTING
+                job.save()
+
+        errors = [(layer_id, e) for (layer_id, _, e) in parallel_map(start, todo, self.workers) if e]
+        for layer_id, e in errors:
+            self.log.error("job %s: group %s: layer %s: %s", job.id, group_name, layer_id, e)
+        if errors:
+            raise errors[0][1]
+
+        # add the draft versions to the publish
+        for layer_id in group['layers']:
+            publish.items.append(self.koordinates_client.get_url('LAYER_VERSION', 'GET', 'single', {
+                'layer_id': layer_id,
+                'version_id': group_state['layer_versions'][layer_id],
+            }))
 
         # commit the publish
         # TODO: error handling
@@ -415,10 +1407,16 @@ class BDEProcessor(object):
             'last_update': timestamp_local(),
         })
         group_state.update(publish_kwargs)
+        group_state.pop('error', None)
         job.save()
 
-    def _start_layer(self, ref, layer_id):
-        """ Begin the update a single layer """
+    def _stage_layer(self, ref, layer_id, take_over=True):
+        """
+        Get a draft version of a layer tagged with ref, creating one if needed.
+        Without take_over, drafts tagged for another job (eg. in an older job's
+        pending publish) are left alone, raising KoordinatesStateError.
+        Returns a (layer, tagged) tuple, tagged is False if the draft was already tagged with ref.
+        """
         try:
             layer = self.koordinates_client.layers.get(layer_id)
         except koordinates.NotFound:
@@ -429,8 +1427,9 @@ class BDEProcessor(object):
             self.log.warn("Layer %s has a draft version already (%s)...", layer_id, layer.latest_version)
             layer = layer.get_draft_version()
             if layer.supplier_reference == ref:
-                self.log.warn("Skipping update of Layer %s (%s) - already importing/imported for this job", layer.id, layer.title)
-                return layer
+                return layer, False
+            elif not take_over and re.match(r'^ldsbde[0-9]+_[0-9]+$', layer.supplier_reference or ''):
+                raise KoordinatesStateError("Layer %s has a draft version for another job (%s)" % (layer_id, layer.supplier_reference))
             else:
                 layer.supplier_reference = ref
                 layer.save()
@@ -439,6 +1438,33 @@ class BDEProcessor(object):
             layer = layer.create_draft_version()
 
         # TODO: use config.tables to check/set/update datasources for this layer to the correct table
+        return layer, True
+
+    def _start_staged_layer(self, layer_id, version_id):
+        """ Begin the import of a pre-staged draft layer version """
+        self.log.info("Beginning update of pre-staged Layer %s (version %s)", layer_id, version_id)
+        try:
+            layer = self.koordinates_client.layers.start_import(layer_id, version_id)
+        except koordinates.Conflict:
+            if self.debug:
+                raise
+            raise KoordinatesStateError("Layer %s (version %s) import failed with Conflict error" % (layer_id, version_id))
+        self.log.info("Layer %s: import started", layer_id)
+        return layer
+
+    def _start_layer(self, ref, layer_id, on_draft=None):
+        """
+        Begin the update a single layer.
+        on_draft(layer) is called once the draft version exists, before the import starts.
+        Returns a (layer, started) tuple, started is False if it was already importing for this job.
+        """
+        layer, tagged = self._stage_layer(ref, layer_id)
+        if not tagged:
+            self.log.warn("Skipping update of Layer %s (%s) - already importing/imported for this job", layer.id, layer.title)
+            return layer, False
+
+        if on_draft:
+            on_draft(layer)
 
         # reimport the Layer from the existing datasources
         self.log.info("Layer %s: new version: %s", layer.id, layer.version.id)
@@ -451,7 +1477,7 @@ class BDEProcessor(object):
             raise KoordinatesStateError("Layer %s (version %s) import failed with Conflict error" % (layer_id, layer.version.id))
         self.log.info("Layer %s: import started", layer_id)
 
-        return layer
+        return layer, True
 
     def error_update(self, job, reason=None):
         """ When an error happens in the BDE Processor. Records it """
@@ -465,23 +1491,23 @@ class BDEProcessor(object):
     def abandon_update(self, job):
         self.log.info("Abandoning Job %s", job.id)
         n_cancelled = 0
+        unpublished = []
         if job.state == Job.STATE_IMPORTING:
-            for publish_group in job.groups:
-                publish_id = publish_group.id
-                publish = self.koordinates_client.publishing.get(publish_id)
-                try:
-                    self.log.info("Cancelling Publish %s", publish_id)
-                    publish.cancel()
+            unpublished = self._unpublished_groups(job)
+            for name, (publish_id, error) in sorted(self.cancel_publishes(job).items()):
+                if error is None:
                     n_cancelled += 1
-                except koordinates.Conflict as e:
-                    if self.debug:
-                        raise
-                    self.log.error("Conflict error cancelling Publish %s: %s", publish_id, e)
-                    pass
+                elif isinstance(error, koordinates.Conflict) and not self.debug:
+                    self.log.error("Conflict error cancelling Publish %s: %s", job.groups[name]['publish_id'], error)
+                else:
+                    raise error
 
         job.state = Job.STATE_ABANDONED
         self.update_job(job)
-        self.notify.error("Job %s: Abandoned. Cancelled %d publishes", job.id, n_cancelled)
+        if unpublished:
+            self.notify.error("Job %s: Abandoned. Cancelled %d publishes, no publish for groups: %s", job.id, n_cancelled, ", ".join(unpublished))
+        else:
+            self.notify.error("Job %s: Abandoned. Cancelled %d publishes", job.id, n_cancelled)
         return job
 
     def email_success(self, job):
@@ -562,22 +1588,320 @@ class BDEProcessor(object):
 
         self.email.error(body, extra={'subject': subject})
 
-    def verify_job(self, job, group, count_only=False):
+    def get_layer_version_info(self, layer, version_id):
+        """
+        Get a dict of metadata (source_revision, feature_count, change_summary, supplier_reference)
+        for a version of the specified layer. Completed non-draft versions are cached on disk.
+        """
+        info = self.version_cache.get_version(layer.id, version_id)
+        if info is None:
+            version = layer.get_version(version_id)
+            info = self.version_cache.set_version(layer.id, version_id, version)
+        return info
+
+    def verify_job(self, job, group, count_only=False, level=None):
+        """
+        Verify all the layer versions in a publish group.
+        The BDE counts for every layer needing checking are fetched with
+        batched queries (see get_bde_counts_batch).
+        level defaults to VERIFY_COUNTS if count_only, otherwise VERIFY_ALL.
+        """
+        level = level or (self.VERIFY_COUNTS if count_only else self.VERIFY_ALL)
+        layers = group.setdefault('layers', {})
+
+        todo = []
+        for layer_id, layerversion_id in sorted(group['layer_versions'].items()):
+            layer_state = layers.setdefault(layer_id, {})
+            result = layer_state.get('verification')
+            if self._verification_covers(result, level) and result['ok']:
+                # failures are always re-checked
+                self.log.info("Layer %s: using existing verification result", layer_id)
+            else:
+                todo.append((layer_id, layerversion_id, layer_state))
+
+        self.log.info("Verifying %s/%s layers...", len(todo), len(group['layer_versions']))
+        checks = []
+        for layer_id, layerversion_id, layer_state in todo:
+            table = self.config.layer_tables[layer_id]
+            layer, prev_version = self._get_verify_versions(layer_id, layerversion_id, table)
+            checks.append((layer_id, layerversion_id, table, layer, prev_version, layer_state))
+
+        batch = []
+        for layer_id, layerversion_id, table, layer, prev_version, layer_state in checks:
+            rev_from = prev_version['source_revision'] if level != self.VERIFY_COUNTS else None
+            batch.append((table, layer.data.source_revision, rev_from))
+
+        exports = {}
+        if level == self.VERIFY_CHECKSUM:
+            # they take a while, so get them all going first
+            for layer_id, layerversion_id, table, layer, prev_version, layer_state in checks:
+                try:
+                    exports[layer_id] = self._get_export(layer, layerversion_id, layer_state)
+                except (koordinates.KoordinatesException, IOError) as e:
+                    # recorded as a verification to retry
+                    exports[layer_id] = e
+
+        with dbwait.deadline(self.verify_job_timeout):
+            batch_results = self.get_bde_counts_batch(batch)
+
+            for check, counts in zip(checks, batch_results):
+                layer_id, layerversion_id, table, layer, prev_version, layer_state = check
+                self._check_verification(layer_id, layerversion_id, table, layer, prev_version, layer_state, level, counts, export=exports.get(layer_id))
+
         errors = []
-        num_layers = len(group['layer_versions'])
-        for i, (layer_id, layerversion_id) in enumerate(sorted(group['layer_versions'].items())):
-            table = self.config_bde['tables'][layer_id]
+        timeouts = []
+        deferred = []
+        for layer_id in sorted(group['layer_versions']):
+            result = layers[layer_id]['verification']
+            if result.get('timeout'):
+                timeouts.append(layer_id)
+            elif result.get('retry'):
+                deferred.append(layer_id)
+            elif not result['ok']:
+                errors.append(ConsistencyError(result['error']))
+        if errors:
+            raise ConsistencyError(errors)
+        if deferred:
+            raise VerificationDeferred("Verification couldn't finish for layers: %s" % ", ".join(map(str, timeouts + deferred)))
+        if timeouts:
+            raise VerificationTimeout("Verification timed out for layers: %s" % ", ".join(map(str, timeouts)))
+
+    def _verification_covers(self, result, level):
+        """ Whether a stored verification result is at least as thorough as level """
+        if not result or result.get('timeout') or result.get('retry'):
+            return False
+        return self.VERIFY_LEVELS.index(result['level']) >= self.VERIFY_LEVELS.index(level)
+
+    def _verify_layer(self, job, layer_id, layerversion_id, layer_state, level):
+        """ Verify a single layer version, storing the result in layer_state """
+        table = self.config.layer_tables[layer_id]
+        layer, prev_version = self._get_verify_versions(layer_id, layerversion_id, table)
+        rev_from = prev_version['source_revision'] if level != self.VERIFY_COUNTS else None
+        export = None
+        if level == self.VERIFY_CHECKSUM:
+            try:
+                export = self._get_export(layer, layerversion_id, layer_state)
+            except (koordinates.KoordinatesException, IOError) as e:
+                export = e
+        counts = self.get_bde_counts_batch([(table, layer.data.source_revision, rev_from)])[0]
+        return self._check_verification(layer_id, layerversion_id, table, layer, prev_version, layer_state, level, counts, export=export)
+
+    def _check_verification(self, layer_id, layerversion_id, table, layer, prev_version, layer_state, level, counts, export=None):
+        """
+        Check a layer version against its get_bde_counts_batch() result (and
+        for VERIFY_CHECKSUM, its content against export or a new export),
+        storing the verification result in layer_state. Problems with the
+        BDE database or the export are recorded as verifications to retry.
+        """
+        result = {'level': level, 'ok': False}
+        if isinstance(counts, dbwait.QueryTimeout):
+            # not a failure, it gets retried next time
+            self.log.warn("Layer %s (%s): verification timed out: %s", layer_id, table, counts)
+            result['timeout'] = True
+            result['error'] = "LayerVersion %s/%s: BDE count query timed out" % (layerversion_id, table)
+        elif isinstance(counts, BDEUnavailable):
+            # nor is this
+            self.log.warn("Layer %s (%s): BDE count query failed, will retry: %s", layer_id, table, counts)
+            result['retry'] = True
+            result['error'] = "LayerVersion %s/%s: BDE count query failed: %s" % (layerversion_id, table, counts)
+        else:
             try:
-                self.verify_change_counts(job, layer_id, layerversion_id, table, count_only=count_only)
+                self.check_change_counts(layer_id, layerversion_id, table, layer, prev_version, *counts)
+                if level == self.VERIFY_CHECKSUM:
+                    if isinstance(export, Exception):
+                        raise export
+                    result['checksum'] = self.check_checksum(layer_id, layerversion_id, table, layer, export=export)
+                result['ok'] = True
             except ConsistencyError as e:
-                errors.append(e)
-            self.log.info("Verified %s/%s...", i, num_layers)
+                result['error'] = str(e)
+            except dbwait.QueryTimeout as e:
+                self.log.warn("Layer %s (%s): checksum timed out: %s", layer_id, table, e)
+                result['timeout'] = True
+                result['error'] = "LayerVersion %s/%s: BDE checksum query timed out" % (layerversion_id, table)
+            except psycopg2.Error as e:
+                self.log.warn("Layer %s (%s): checksum query failed, will retry: %s", layer_id, table, e)
+                result['retry'] = True
+                result['error'] = "LayerVersion %s/%s: BDE checksum query failed: %s" % (layerversion_id, table, str(e).strip())
+            except (KoordinatesStateError, koordinates.KoordinatesException, IOError) as e:
+                # eg. the export failed or timed out, start a new one next time
+                self.log.warn("Layer %s (%s): checksum export failed, will retry: %s", layer_id, table, e)
+                layer_state.pop('export', None)
+                result['retry'] = True
+                result['error'] = "LayerVersion %s/%s: checksum export failed: %s" % (layerversion_id, table, e)
+        result['verified_at'] = timestamp_local()
+        layer_state['verification'] = result
+        return result
+
+    def check_checksum(self, layer_id, layerversion_id, table, layer, export=None):
+        """
+        Compare the content of a LayerVersion with the BDE table at its
+        revision, raising ConsistencyError if they differ.
 
-        if errors:
-            raise ConsistencyError(errors)
+        The LayerVersion is exported as CSV (or export, from _start_export()
+        is used) and both sides are fingerprinted (see ldsbde.core.checksum)
+        over the non-geometry columns they have in common, less
+        bde.checksum.ignore_columns. Returns a summary of the checksum.
+        """
+        if export is None:
+            export = self._start_export(layer)
+        bde_columns = self._table_columns(table)
+
+        with self._download_export(export) as path:
+            with zipfile.ZipFile(path) as zf:
+                names = [n for n in zf.namelist() if n.lower().endswith('.csv')]
+                if len(names) != 1:
+                    raise ConsistencyError("Export %s for LayerVersion %s/%s has %s CSV files" % (export.id, layerversion_id, table, len(names)))
+
+                header = checksum.csv_header(zf.open(names[0]))
+                columns = [c for c in bde_columns if c.lower() in header and c.lower() not in self.checksum_ignore_columns]
+                if not columns:
+                    raise ConsistencyError("Export %s for LayerVersion %s/%s has no columns in common with BDE" % (export.id, layerversion_id, table))
+
+                batches = checksum.csv_batches(zf.open(names[0]), [c.lower() for c in columns], self.checksum_batch_size)
+                export_fingerprint = checksum.parallel_fingerprint(batches, self._checksum_pool, 2 * self.checksum_processes)
+
+        bde_fingerprint = self.get_bde_fingerprint(table, layer.data.source_revision, columns)
+        self.log.info("Layer %s (%s): checksums over %d columns - expected: %s actual: %s",
+            layer_id,
+            table,
+            len(columns),
+            checksum.format_fingerprint(bde_fingerprint),
+            checksum.format_fingerprint(export_fingerprint)
+        )
+        if bde_fingerprint != export_fingerprint:
+            raise ConsistencyError("LayerVersion %s/%s (BDE rev %s) content checksum is %s, BDE says %s" % (
+                layerversion_id, table, layer.data.source_revision,
+                checksum.format_fingerprint(export_fingerprint),
+                checksum.format_fingerprint(bde_fingerprint)
+            ))
+        return {
+            'columns': len(columns),
+            'rows': bde_fingerprint[0],
+            'checksum': '%016x' % bde_fingerprint[1],
+        }
+
+    def get_bde_fingerprint(self, table, rev, columns):
+        """
+        Fingerprint (see ldsbde.core.checksum) some columns of a BDE table at a
+        revision. Rows are streamed from ver_get_*_revision() through a
+        server-side cursor in bde.checksum.batch_size batches, and hashed across
+        the checksum processes (see start_checksum_pool()). Values are cast to
+        text in ISO DateStyle so they're normalised like the CSV export's.
+        Raises dbwait.QueryTimeout if it takes longer than bde.verify_timeout seconds.
+        """
+        schema_name, table_name = table.split('.')
+        sql = "SELECT %s FROM table_version.ver_get_%s_%s_revision(%%s)" % (
+            ", ".join('"%s"::text' % c.replace('"', '""') for c in columns),
+            schema_name,
+            table_name,
+        )
+
+        with dbwait.deadline(self.verify_timeout):
+            with self.db.connection() as conn:
+                remaining = dbwait.remaining()
+                self.db.execute(self.db.cursor(conn, dict_rows=False), "SET LOCAL DateStyle = 'ISO, YMD'")
+                if remaining is not None:
+                    self.db.execute(self.db.cursor(conn, dict_rows=False), "SET LOCAL statement_timeout = %s", (int(remaining * 1000),))
+
+                cur = conn.cursor(name='ldsbde_checksum')
+                self.db.execute(cur, sql, (rev,))
+
+                def batches():
+                    while True:
+                        rows = cur.fetchmany(self.checksum_batch_size)
+                        if not rows:
+                            return
+                        yield rows
+
+                return checksum.parallel_fingerprint(batches(), self._checksum_pool, 2 * self.checksum_processes)
+
+    def _table_columns(self, table):
+        """ Names of a BDE table's non-geometry columns, in order """
+        schema_name, table_name = table.split('.')
+        rows = self.db.fetchall("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = %s
+                AND udt_name NOT IN ('geometry', 'geography')
+            ORDER BY ordinal_position
+        """, (schema_name, table_name), prepare=True, dict_rows=False)
+        return [row[0] for row in rows]
+
+    def _start_export(self, layer):
+        """ Start a CSV export of a LayerVersion """
+        export = koordinates.Export()
+        export.set_formats(vector='text/csv', table='text/csv')
+        crs = getattr(layer.data, 'crs', None)
+        if crs:
+            export.crs = crs
+        export.add_item(layer)
+        export = self.koordinates_client.exports.create(export)
+        self.log.info("Layer %s: started export %s for checksum", layer.id, export.id)
+        return export
+
+    def _get_export(self, layer, layerversion_id, layer_state):
+        """
+        The CSV export of a LayerVersion for its checksum: the one recorded in
+        layer_state by an earlier pass if it's still usable, otherwise a new one.
+        """
+        previous = layer_state.get('export')
+        if previous and previous['layerversion_id'] == layerversion_id:
+            try:
+                export = self.koordinates_client.exports.get(previous['id'])
+            except koordinates.NotFound:
+                export = None
+            if export is not None and export.state in ('processing', 'complete'):
+                self.log.info("Layer %s: reusing export %s for checksum", layer.id, export.id)
+                return export
+
+        export = self._start_export(layer)
+        layer_state['export'] = {'id': export.id, 'layerversion_id': layerversion_id}
+        return export
+
+    @contextlib.contextmanager
+    def _download_export(self, export):
+        """
+        Wait for an export to finish (up to bde.checksum.export_timeout seconds)
+        and download it to a temporary file, yielding its path.
+        """
+        give_up = time.time() + self.export_timeout
+        while export.state == 'processing':
+            if time.time() > give_up:
+                export.cancel()
+                raise KoordinatesStateError("Export %s didn't finish within %s seconds" % (export.id, self.export_timeout))
+            time.sleep(self.export_poll_interval)
+            export = self.koordinates_client.exports.get(export.id)
+
+        if export.state != 'complete':
+            raise KoordinatesStateError("Export %s is %s" % (export.id, export.state))
+
+        fd, path = tempfile.mkstemp(prefix='ldsbde-export-', suffix='.zip')
+        os.close(fd)
+        try:
+            export.download(path)
+            yield path
+        finally:
+            os.remove(path)
 
     def verify_change_counts(self, job, layer_id, layerversion_id, table, count_only=False):
-        """ Verify the change counts """
+        """
+        Verify the change counts of one layer version, via get_bde_counts_batch().
+        Raises ConsistencyError if they don't match, or the query's
+        dbwait.QueryTimeout / BDEUnavailable if it couldn't run.
+        """
+        layer, prev_version = self._get_verify_versions(layer_id, layerversion_id, table)
+        rev_from = prev_version['source_revision'] if not count_only else None
+        counts = self.get_bde_counts_batch([(table, layer.data.source_revision, rev_from)])[0]
+        if isinstance(counts, Exception):
+            raise counts
+
+        bde_row_count, bde_changes = counts
+        self.check_change_counts(layer_id, layerversion_id, table, layer, prev_version, bde_row_count, bde_changes)
+
+    def _get_verify_versions(self, layer_id, layerversion_id, table):
+        """
+        Get the LayerVersion being verified and the metadata of the version before it.
+        Returns a (layer, prev_version) tuple.
+        """
         layer = self.koordinates_client.layers.get_version(layer_id, layerversion_id)
 
         # not sure if we guarantee sort order? Is ascending atm.
@@ -602,17 +1926,22 @@ class BDEProcessor(object):
             raise KoordinatesStateError("No previous version found (LV=%s L=%s)" % (layerversion_id, layer_id))
         else:
             prev_version_id = version_list[idx-1].id
-            prev_version = layer.get_version(prev_version_id)
+            prev_version = self.get_layer_version_info(layer, prev_version_id)
             self.log.info("Layer %s (%s): previous=LV %s / BDE %s / Ref %s",
                 layer_id,
                 table,
                 prev_version_id,
-                prev_version.data.source_revision,
-                prev_version.supplier_reference
+                prev_version['source_revision'],
+                prev_version['supplier_reference']
             )
+        return layer, prev_version
 
+    def check_change_counts(self, layer_id, layerversion_id, table, layer, prev_version, bde_row_count, bde_changes=None):
+        """
+        Compare a LayerVersion against BDE counts, raising ConsistencyError if they differ.
+        bde_changes is an (INSERTs, UPDATEs, DELETEs) tuple, or None to skip change-count checks.
+        """
         # Check feature counts
-        bde_row_count = self.get_bde_row_count(table, layer.data.source_revision)
         self.log.info("Layer %s (%s): feature counts - expected: %s actual: %s",
             layer_id,
             table,
@@ -622,16 +1951,16 @@ class BDEProcessor(object):
         if bde_row_count != layer.data.feature_count:
             raise ConsistencyError("LayerVersion %s/%s (BDE rev %s) has %s features, BDE says %s" % (layerversion_id, table, layer.data.source_revision, layer.data.feature_count, bde_row_count))
 
-        if prev_version.data.source_revision is None:
+        if prev_version['source_revision'] is None:
             self.log.info("Previous BDE revision is None, skipping change-count checks")
             return
 
-        if count_only:
+        if bde_changes is None:
             self.log.info("Skipping insert/update/delete counts")
             return
 
         # Check change counts
-        (bde_inserts, bde_updates, bde_deletes) = self.get_bde_change_counts(table, prev_version.data.source_revision, layer.data.source_revision)
+        (bde_inserts, bde_updates, bde_deletes) = bde_changes
         version_changes = layer.data.change_summary
         self.log.info("Layer %s (%s): change counts - expected: I%s/U%s/D%s actual: I%s/U%s/D%s",
             layer_id,
@@ -647,4 +1976,3 @@ class BDEProcessor(object):
                 version_changes['inserted'], version_changes['updated'], version_changes['deleted'],
                 bde_inserts, bde_updates, bde_deletes
             ))
-
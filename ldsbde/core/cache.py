@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Small persistent key/value cache stored as a JSON file.
+
+    Keys are strings, values must be JSON-serializable. Once more than
+    max_size entries are stored the least-recently-used ones are evicted.
+    Changes are kept in memory until flush() is called.
+    """
+    def __init__(self, path, max_size=1000):
+        self.log = logging.getLogger("ldsbde.cache")
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.RLock()
+        self._data = None
+        self._dirty = False
+
+    def _entries(self):
+        if self._data is None:
+            data = OrderedDict()
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, 'r') as fd:
+                        data = json.load(fd, object_pairs_hook=OrderedDict)
+                except ValueError:
+                    self.log.warn("Ignoring corrupt cache file: %s", self.path)
+            self._data = data
+        return self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries())
+
+    def get(self, key, default=None):
+        with self._lock:
+            entries = self._entries()
+            if key not in entries:
+                return default
+            # mark as most-recently used
+            value = entries.pop(key)
+            entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            entries = self._entries()
+            entries.pop(key, None)
+            entries[key] = value
+            while len(entries) > self.max_size:
+                evicted, _ = entries.popitem(last=False)
+                self.log.debug("Evicted %s from %s", evicted, self.path)
+            self._dirty = True
+
+    def flush(self):
+        """ Save the cache if it's changed since it was last saved """
+        with self._lock:
+            if self._dirty:
+                self.save()
+
+    def save(self):
+        """ Atomically write the cache to disk """
+        with self._lock:
+            entries = self._entries()
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', prefix='.cache-')
+            try:
+                with os.fdopen(fd, 'w') as fp:
+                    json.dump(entries, fp)
+                os.rename(tmp_path, self.path)
+            except:
+                os.remove(tmp_path)
+                raise
+            self._dirty = False
+
+
+class VersionCache(LRUCache):
+    """
+    Cache of immutable Koordinates LayerVersion metadata, keyed by (layer_id, version_id).
+    Only completed, non-draft versions are stored: anything else can still change.
+    """
+    FIELDS = ('source_revision', 'feature_count', 'change_summary')
+
+    @staticmethod
+    def _key(layer_id, version_id):
+        return "%s:%s" % (layer_id, version_id)
+
+    @staticmethod
+    def is_cacheable(layer):
+        status = getattr(getattr(layer, 'version', None), 'status', None)
+        return status == 'ok' and not layer.is_draft_version
+
+    @classmethod
+    def snapshot(cls, layer):
+        """ Extract the metadata we care about from a Layer(Version) object """
+        info = dict((f, getattr(layer.data, f, None)) for f in cls.FIELDS)
+        info['supplier_reference'] = layer.supplier_reference
+        return info
+
+    def get_version(self, layer_id, version_id):
+        return self.get(self._key(layer_id, version_id))
+
+    def set_version(self, layer_id, version_id, layer):
+        info = self.snapshot(layer)
+        if self.is_cacheable(layer):
+            self.set(self._key(layer_id, version_id), info)
+        return info
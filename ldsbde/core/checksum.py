@@ -0,0 +1,165 @@
+"""
+Order-independent content fingerprints of table rows.
+
+Each row's values are normalised to text (see canonical()) and hashed; a
+fingerprint is the row count and the sum of the row hashes modulo 2**64, so
+it doesn't depend on row order, can be computed over batches in parallel and
+combined, and only ever holds one batch of rows in memory.
+
+Database values should be fetched cast to text (with DateStyle ISO) so both
+sides of a comparison are normalised from the same representation.
+"""
+import collections
+import csv
+import datetime
+import decimal
+import hashlib
+import io
+import multiprocessing
+import re
+import struct
+import sys
+
+# (row count, sum of row hashes mod 2**64)
+EMPTY = (0, 0)
+
+_MASK = 2 ** 64 - 1
+_NUMBER = re.compile(r'^[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?$')
+_DATETIME = re.compile(r'^([0-9]{4})-([0-9]{2})-([0-9]{2})[T ]([0-9]{2}):([0-9]{2}):([0-9]{2})(?:\.([0-9]+))?\s*(Z|[-+][0-9]{2}(?::?[0-9]{2})?)?$')
+_SEPARATOR = u'\x1f'
+
+
+def canonical(value):
+    """
+    Normalise a value from the database or an export to text, so the same
+    value compares equal from either: NULLs are empty, numbers lose trailing
+    zeros, booleans are true/false, date-times are ISO 8601 in UTC, and
+    strings are stripped. Typed values (datetimes, Decimals, floats) are
+    formatted as text first, the same way Postgres casts them.
+    """
+    if value is None:
+        return u''
+    if isinstance(value, bool):
+        return u'true' if value else u'false'
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    elif isinstance(value, (datetime.date, datetime.time)):
+        value = type(u'')(value.isoformat())
+    elif isinstance(value, float):
+        value = type(u'')(repr(value))
+    elif not isinstance(value, type(u'')):
+        value = type(u'')(value)
+
+    value = value.strip()
+    m = _DATETIME.match(value)
+    if value.lower() in (u't', u'true'):
+        return u'true'
+    elif value.lower() in (u'f', u'false'):
+        return u'false'
+    elif _NUMBER.match(value):
+        return type(u'')(decimal.Decimal(value).normalize())
+    elif m:
+        return _canonical_datetime(*m.groups())
+    return value
+
+
+def _canonical_datetime(year, month, day, hour, minute, second, fraction, zone):
+    value = datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
+    suffix = u''
+    if zone:
+        if zone != 'Z':
+            digits = zone[1:].replace(':', '')
+            offset = datetime.timedelta(hours=int(digits[:2]), minutes=int(digits[2:] or 0))
+            value = value - offset if zone[0] == '+' else value + offset
+        suffix = u'Z'
+    fraction = (fraction or '').rstrip('0')
+    return u'%04d-%02d-%02dT%02d:%02d:%02d%s%s' % (
+        value.year, value.month, value.day, value.hour, value.minute, value.second,
+        u'.' + fraction if fraction else u'',
+        suffix,
+    )
+
+
+def fingerprint_rows(rows):
+    """ Fingerprint a batch of rows (sequences of values) """
+    total = 0
+    count = 0
+    for row in rows:
+        data = _SEPARATOR.join(canonical(v) for v in row).encode('utf-8')
+        total += struct.unpack('<Q', hashlib.sha1(data).digest()[:8])[0]
+        count += 1
+    return (count, total & _MASK)
+
+
+def combine(a, b):
+    return (a[0] + b[0], (a[1] + b[1]) & _MASK)
+
+
+def create_pool(processes):
+    """
+    Start a pool of processes for parallel_fingerprint(), to be shared.
+    Workers are spawned rather than forked where Python supports it (3.4+).
+    On Python 2 they're forked, so call this from the main thread before
+    starting any other threads or opening connections.
+    """
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('spawn').Pool(processes)
+    return multiprocessing.Pool(processes)
+
+
+def parallel_fingerprint(batches, pool=None, read_ahead=8):
+    """
+    Fingerprint an iterable of row batches across a pool from create_pool(),
+    or in this process without one. At most read_ahead batches are queued,
+    so memory use doesn't depend on the number of rows.
+    """
+    result = EMPTY
+    if pool is None:
+        for batch in batches:
+            result = combine(result, fingerprint_rows(batch))
+        return result
+
+    # batches are read in this thread, so any dbwait.deadline() still applies
+    pending = collections.deque()
+    for batch in batches:
+        pending.append(pool.apply_async(fingerprint_rows, (batch,)))
+        if len(pending) >= read_ahead:
+            result = combine(result, pending.popleft().get())
+    while pending:
+        result = combine(result, pending.popleft().get())
+    return result
+
+
+def format_fingerprint(fingerprint):
+    return "%d rows, %016x" % fingerprint
+
+
+def csv_header(fd):
+    """ The lower-cased column names from the first row of a CSV file object """
+    return [c.lower() for c in next(_csv_reader(fd))]
+
+
+def csv_batches(fd, columns, batch_size=10000):
+    """
+    Read a CSV file object with a header row in batches of rows, each a tuple
+    of the named (lower-case) columns' values.
+    """
+    reader = _csv_reader(fd)
+    header = [c.lower() for c in next(reader)]
+    indexes = [header.index(c) for c in columns]
+    batch = []
+    for row in reader:
+        batch.append(tuple(row[i] for i in indexes))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _csv_reader(fd):
+    # exports include geometries as WKT, which can be huge
+    csv.field_size_limit(2 ** 31 - 1)
+    if sys.version_info[0] >= 3:
+        fd = io.TextIOWrapper(fd, encoding='utf-8', newline='')
+    return csv.reader(fd)
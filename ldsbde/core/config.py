@@ -0,0 +1,233 @@
+import datetime
+import hashlib
+import itertools
+import logging
+import os
+import tempfile
+from collections import Counter
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import dateutil.rrule
+import yaml
+
+from ldsbde.core import exc
+
+
+L = logging.getLogger("ldsbde.config")
+
+
+class FrozenDict(dict):
+    """ Read-only dict, for indexes shared between threads & targets """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("%s is read-only" % type(self).__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+class CompiledConfig(dict):
+    """
+    Parsed & validated config file contents.
+
+    Behaves as the plain config dict, plus precomputed indexes over the
+    'bde' section (if there is one), which are validated once on creation
+    and are read-only (FrozenDicts & tuples):
+
+        layer_tables: {layer_id: 'schema.table'}
+        groups: tuple of the publish group dicts, in config order
+        group_names: tuple of the publish group names, in config order
+        layer_groups: {layer_id: group name}
+        table_layers: {'schema.table': tuple of layer_ids}
+        targets: {name: CompiledConfig} for the extra Koordinates sites in
+            koordinates.targets, with their own layer IDs mapped in
+    """
+    # bump when the compiled structure changes, to invalidate cache files
+    VERSION = 3
+
+    def __init__(self, data):
+        super(CompiledConfig, self).__init__(data)
+        self._schedules = {}
+
+        bde = self.get('bde')
+        if bde:
+            self.validate_bde(bde['tables'], bde['groups'])
+
+        tables = bde['tables'] if bde else {}
+        self.layer_tables = FrozenDict(tables)
+        self.groups = tuple(FrozenDict(g, layers=tuple(g['layers'])) for g in bde['groups']) if bde else ()
+        self.group_names = tuple(g['name'] for g in self.groups)
+        self.layer_groups = FrozenDict((layer_id, g['name']) for g in self.groups for layer_id in g['layers'])
+        table_layers = {}
+        for layer_id, table in sorted(tables.items()):
+            table_layers.setdefault(table, []).append(layer_id)
+        self.table_layers = FrozenDict((t, tuple(l)) for t, l in table_layers.items())
+
+        targets = {}
+        for name, target in sorted((self.get('koordinates') or {}).get('targets', {}).items()):
+            targets[name] = self._compile_target(name, target)
+        self.targets = FrozenDict(targets)
+
+        # check the schedules parse
+        for group in self.groups:
+            schedule = group.get('schedule', None)
+            try:
+                self.schedule_matches(schedule)
+            except (ValueError, TypeError) as e:
+                raise exc.ConfigError("Invalid schedule for group %s (%s): %s" % (group['name'], schedule, e))
+
+    def _compile_target(self, name, target):
+        """
+        Build the config for an extra Koordinates target. It inherits the
+        'koordinates' options, and target['layers'] maps our layer IDs to the
+        target's layer IDs (unmapped layers have the same ID on both sites).
+        """
+        if 'bde' not in self:
+            raise exc.ConfigError("koordinates.targets needs a bde section")
+
+        layer_map = dict(target.get('layers', {}))
+        unknown = set(layer_map) - set(self.layer_tables)
+        if unknown:
+            raise exc.ConfigError("Layers in koordinates.targets.%s.layers not in bde.tables: %s" % (name, str(list(unknown))))
+        target_ids = [layer_map.get(layer_id, layer_id) for layer_id in self.layer_tables]
+        dupes = [x for x, n in Counter(target_ids).items() if n > 1]
+        if dupes:
+            raise exc.ConfigError("Repeated Layers in koordinates.targets.%s.layers: %s" % (name, str(dupes)))
+
+        api_config = dict((k, v) for k, v in self['koordinates'].items() if k != 'targets')
+        api_config.update((k, v) for k, v in target.items() if k != 'layers')
+
+        bde_config = dict(self['bde'])
+        bde_config['tables'] = dict((layer_map.get(l, l), t) for l, t in self.layer_tables.items())
+        bde_config['groups'] = [
+            dict(g, layers=[layer_map.get(l, l) for l in g['layers']]) for g in self.groups
+        ]
+
+        data = dict(self)
+        data['koordinates'] = api_config
+        data['bde'] = bde_config
+        return CompiledConfig(data)
+
+    @staticmethod
+    def validate_bde(tables, groups):
+        """ Validate that layers/tables/groups listed in the BDE config file are sane """
+        mapped = Counter(tables.keys())
+        published = Counter(itertools.chain(*[g['layers'] for g in groups]))
+
+        dupe_mapped = [x for x, n in mapped.items() if n > 1]
+        if dupe_mapped:
+            raise exc.ConfigError("Repeated Layers in bde.tables: %s" % str(dupe_mapped))
+
+        dupe_published = [x for x, n in published.items() if n > 1]
+        if dupe_published:
+            raise exc.ConfigError("Repeated Layers in bde.groups: %s" % str(dupe_published))
+
+        dupe_groups = [x for x, n in Counter(g['name'] for g in groups).items() if n > 1]
+        if dupe_groups:
+            raise exc.ConfigError("Repeated group names in bde.groups: %s" % str(dupe_groups))
+
+        # we know they're unique now
+        mapped_layer_ids = set(mapped)
+        published_layer_ids = set(published)
+
+        mapped_extra = mapped_layer_ids - published_layer_ids
+        if mapped_extra:
+            raise exc.ConfigError("Layers listed in bde.tables not in bde.groups: %s" % str(list(mapped_extra)))
+
+        publish_extra = published_layer_ids - mapped_layer_ids
+        if publish_extra:
+            raise exc.ConfigError("Layers listed in bde.groups not in bde.tables: %s" % str(list(publish_extra)))
+
+    def schedule_matches(self, schedule, day=None):
+        """
+        Whether a group schedule (RFC2445 RRULE, or True/False/'*'/None) includes day (default today).
+        Parsed rules are memoized.
+        """
+        if schedule == "*" or schedule == True or schedule is None:
+            return True
+        elif not schedule:  # False
+            return False
+
+        day = day or datetime.date.today()
+        key = (schedule, day)
+        if key not in self._schedules:
+            # dtstart matters to the rule (eg. the default BYWEEKDAY), so it's per-day
+            rule = dateutil.rrule.rrulestr(schedule, dtstart=day)
+            self._schedules[key] = (rule[0].date() == day)
+        return self._schedules[key]
+
+    def __reduce__(self):
+        # memoized schedules are only good for the day
+        attrs = dict(self.__dict__, _schedules={})
+        return (_restore, (dict(self), attrs))
+
+
+def _restore(data, attrs):
+    config = dict.__new__(CompiledConfig)
+    dict.update(config, data)
+    config.__dict__.update(attrs)
+    return config
+
+
+def load(path, cache_dir=None):
+    """
+    Load & compile a YAML config file.
+
+    If cache_dir is set the compiled config is cached there, and reused while
+    the config file's path, size & modification time are unchanged.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (CompiledConfig.VERSION, path, stat.st_size, stat.st_mtime)
+
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, "config-%s.cache" % hashlib.sha1(path.encode('utf-8')).hexdigest()[:16])
+        config = _load_cache(cache_path, key)
+        if config is not None:
+            L.debug("Using compiled config from %s", cache_path)
+            return config
+
+    with open(path, 'r') as fd:
+        config = CompiledConfig(yaml.safe_load(fd) or {})
+
+    if cache_path:
+        _save_cache(cache_path, key, config)
+    return config
+
+
+def _load_cache(cache_path, key):
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as fd:
+            cached_key, config = pickle.load(fd)
+    except Exception as e:
+        L.warn("Ignoring unreadable config cache %s: %s", cache_path, e)
+        return None
+    if cached_key != key:
+        return None
+    return config
+
+
+def _save_cache(cache_path, key, config):
+    """ Atomically write the compiled config cache, failures are only logged """
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, 0o770)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.config-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump((key, config), fp, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, cache_path)
+        except:
+            os.remove(tmp_path)
+            raise
+    except (IOError, OSError) as e:
+        L.warn("Couldn't save config cache %s: %s", cache_path, e)
@@ -0,0 +1,225 @@
+import contextlib
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+
+from ldsbde.core import dbwait
+
+
+class QueryMetrics(object):
+    """ Thread-safe per-query-type statement counts & timings """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.kinds = defaultdict(lambda: {
+            'calls': 0,
+            'errors': 0,
+            'time': 0.0,
+            'max_time': 0.0,
+        })
+
+    @staticmethod
+    def kind(sql):
+        """
+        Normalise a statement to a query type: its verb and the tables &
+        functions it uses, with per-table names wildcarded,
+        eg. 'SELECT table_version.ver_get_*_diff'
+        """
+        verb = sql.split(None, 1)[0].upper()
+        names = set(re.findall(r'\b(?:FROM|JOIN)\s+([\w."]+)', sql, re.I))
+        names.update(re.findall(r'\b(\w+\.\w+)\s*\(', sql))
+        objects = set()
+        for name in names:
+            name = name.replace('"', '')
+            if name.startswith('pg_catalog.'):
+                name = 'pg_catalog'
+            elif name.startswith('table_version.') and name != 'table_version.ver_get_last_revision':
+                name = re.sub(r'^table_version\.(ver_get_)?\w+_(revision|diff)$', r'table_version.\1*_\2', name)
+            objects.add(name)
+        return " ".join([verb] + sorted(objects))
+
+    def record(self, kind, elapsed, error=False):
+        with self._lock:
+            stats = self.kinds[kind]
+            stats['calls'] += 1
+            stats['time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            if error:
+                stats['errors'] += 1
+
+    def counts(self):
+        """ {query type: number of statements} """
+        with self._lock:
+            return dict((kind, stats['calls']) for kind, stats in self.kinds.items())
+
+    def summary(self):
+        """ Return a list of summary lines, one per query type """
+        with self._lock:
+            lines = []
+            for kind, stats in sorted(self.kinds.items()):
+                lines.append("%s: %d statements, %d errors, %.1fs total, %.1fs max" % (
+                    kind, stats['calls'], stats['errors'], stats['time'], stats['max_time']
+                ))
+            return lines
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """ psycopg2 connection which tracks its server-side prepared statements """
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+        self.last_used = time.time()
+
+
+class Database(object):
+    """
+    Thread-safe pool of Postgres connections.
+
+    Connections are opened on first use, health-checked when they've been
+    idle for health_check_interval seconds, and replaced if they've died.
+    When all max_connections are in use, callers wait for one to be returned
+    (psycopg2's pool would raise PoolError).
+    Queries can be run as server-side prepared statements so repeated
+    queries are only planned once per connection. Statements run via
+    execute() are counted in metrics.
+    """
+    def __init__(self, connect_kwargs, min_connections=1, max_connections=4, health_check_interval=60):
+        self.log = logging.getLogger("ldsbde.db")
+        self.connect_kwargs = connect_kwargs
+        self.min_connections = min_connections
+        self.max_connections = max(min_connections, max_connections)
+        self.health_check_interval = health_check_interval
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_connections)
+        self.metrics = QueryMetrics()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                dbwait.install()
+                self._pool = psycopg2.pool.ThreadedConnectionPool(
+                    self.min_connections,
+                    self.max_connections,
+                    connection_factory=PreparingConnection,
+                    **self.connect_kwargs
+                )
+            return self._pool
+
+    def close(self):
+        """ Close all the pooled connections """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.time() - conn.last_used < self.health_check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            self.log.warn("Discarding broken database connection: %s", e)
+            return False
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Check a connection out of the pool, waiting if they're all in use.
+        Its transaction is rolled back when it's returned: everything we do
+        is read-only.
+        """
+        self._slots.acquire()
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+            while not self._is_healthy(conn):
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # probably lost the connection, don't reuse it
+                pool.putconn(conn, close=True)
+                raise
+            except BaseException:
+                self._release(pool, conn)
+                raise
+            else:
+                self._release(pool, conn)
+        finally:
+            self._slots.release()
+
+    def _release(self, pool, conn):
+        close = conn.closed
+        if not close:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+        conn.last_used = time.time()
+        pool.putconn(conn, close=bool(close))
+
+    @staticmethod
+    def cursor(conn, dict_rows=True):
+        """ Get a DictCursor, or a plain tuple cursor (cheaper for counts) """
+        if dict_rows:
+            return conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        return conn.cursor()
+
+    def execute(self, cur, sql, params=(), prepare=False):
+        """
+        Execute sql (with %s placeholders only) on a cursor.
+        With prepare, it's run as a server-side prepared statement, created
+        on the cursor's connection the first time it's used there.
+        """
+        start = time.time()
+        try:
+            self._execute(cur, sql, params, prepare)
+        except Exception:
+            self.metrics.record(self.metrics.kind(sql), time.time() - start, error=True)
+            raise
+        self.metrics.record(self.metrics.kind(sql), time.time() - start)
+        return cur
+
+    def _execute(self, cur, sql, params, prepare):
+        if not prepare:
+            cur.execute(sql, params)
+            return
+
+        conn = cur.connection
+        name = "ldsbde_%s" % hashlib.md5(sql.encode('utf-8')).hexdigest()[:16]
+        if name not in conn.prepared:
+            placeholders = tuple("$%d" % (i + 1) for i in range(len(params)))
+            cur.execute("PREPARE %s AS %s" % (name, sql % placeholders))
+            conn.prepared.add(name)
+            self.log.debug("Prepared %s: %s", name, sql)
+
+        if params:
+            cur.execute("EXECUTE %s (%s)" % (name, ", ".join(["%s"] * len(params))), params)
+        else:
+            cur.execute("EXECUTE %s" % name)
+
+    def fetchone(self, sql, params=(), prepare=False, dict_rows=True):
+        with self.connection() as conn:
+            cur = self.cursor(conn, dict_rows)
+            return self.execute(cur, sql, params, prepare).fetchone()
+
+    def fetchall(self, sql, params=(), prepare=False, dict_rows=True):
+        with self.connection() as conn:
+            cur = self.cursor(conn, dict_rows)
+            return self.execute(cur, sql, params, prepare).fetchall()
@@ -0,0 +1,115 @@
+"""
+Cancellable, deadline-aware Postgres queries.
+
+wait_select() is installed as the psycopg2 wait callback, so every query runs
+in green mode and is waited on here instead of blocking inside libpq. When a
+query's deadline (see deadline()) passes, or the process is asked to stop via
+SIGTERM/Ctrl-C, the query is cancelled on the server with connection.cancel().
+"""
+import contextlib
+import logging
+import select
+import signal
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+from ldsbde.core import exc
+
+
+# how often blocked queries check their deadline & for termination (seconds)
+POLL_INTERVAL = 1.0
+
+L = logging.getLogger("ldsbde.dbwait")
+
+_local = threading.local()
+_terminate = threading.Event()
+
+
+class QueryTimeout(exc.RuntimeError):
+    """ A query was cancelled because its deadline passed """
+    pass
+
+
+def install():
+    """ Run all psycopg2 queries through wait_select() """
+    psycopg2.extensions.set_wait_callback(wait_select)
+
+
+def install_signal_handlers():
+    """
+    Cancel running queries on SIGTERM, then exit.
+    Must be called from the main thread.
+    """
+    def handler(signum, frame):
+        L.warn("Received signal %s, cancelling queries", signum)
+        _terminate.set()
+        raise SystemExit(128 + signum)
+    signal.signal(signal.SIGTERM, handler)
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """
+    Cancel queries in this thread still running after seconds.
+    Nested deadlines can only shorten the outer one. None means no limit.
+    """
+    previous = getattr(_local, 'deadline', None)
+    if seconds is not None:
+        new = time.time() + seconds
+        _local.deadline = new if previous is None else min(previous, new)
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def remaining():
+    """ Seconds until the current deadline, or None if there isn't one """
+    current = getattr(_local, 'deadline', None)
+    if current is None:
+        return None
+    return max(0, current - time.time())
+
+
+def wait_select(conn):
+    """ psycopg2 wait callback which enforces deadlines & cancels on termination """
+    cancelled = None
+    while True:
+        try:
+            state = conn.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                return
+
+            if cancelled is None:
+                if _terminate.is_set():
+                    cancelled = 'terminated'
+                    conn.cancel()
+                elif remaining() == 0:
+                    cancelled = 'timeout'
+                    conn.cancel()
+
+            if state == psycopg2.extensions.POLL_READ:
+                select.select([conn.fileno()], [], [], POLL_INTERVAL)
+            elif state == psycopg2.extensions.POLL_WRITE:
+                select.select([], [conn.fileno()], [], POLL_INTERVAL)
+            else:
+                raise psycopg2.OperationalError("Bad result from poll: %r" % state)
+
+        except psycopg2.extensions.QueryCanceledError:
+            if cancelled == 'timeout':
+                raise QueryTimeout("Query cancelled after its deadline passed")
+            raise
+
+        except BaseException:
+            # Ctrl-C or SIGTERM: stop the server-side query then carry on exiting
+            if cancelled is None:
+                cancelled = 'terminated'
+                L.warn("Cancelling running query")
+                try:
+                    conn.cancel()
+                except psycopg2.Error:
+                    pass
+            raise
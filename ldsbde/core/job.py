@@ -19,6 +19,10 @@ class Job(object):
     STATE_ERRORS = 'errors'
     STATE_COMPLETE = 'complete'
     STATE_ABANDONED = 'abandoned'
+    STATE_SUPERSEDED = 'superseded'
+
+    # states which jobs never leave by themselves
+    TERMINAL_STATES = (STATE_BDE_ERROR, STATE_COMPLETE, STATE_ABANDONED, STATE_SUPERSEDED)
 
     @classmethod
     def create(cls, id, save_func=None):
@@ -36,15 +40,19 @@ class Job(object):
         return cls(data, save_func=save_func)
 
     @classmethod
-    def parse(cls, serialized, job_id=None, save_func=None):
+    def parse(cls, serialized, job_id=None, save_func=None, targets=None):
         """
         Deserialize some data into a Job object.
         If ID is passed, check the data against the passed ID.
+        targets is a dict of serialized Jobs for extra Koordinates targets.
         """
         if job_id and serialized['id'] != job_id:
             raise exc.ArgumentError("ID mismatch when parsing Job %s (id=%s)" % (job_id, serialized['id']))
 
-        return cls(serialized, save_func=save_func)
+        job = cls(serialized, save_func=save_func)
+        for name, data in (targets or {}).items():
+            job._targets[name] = cls(data, save_func=save_func, target_name=name)
+        return job
 
 
     def serialize(self):
@@ -52,12 +60,16 @@ class Job(object):
         timestamp = timestamp_local()
         if not self.changes or (self.state != self.changes[-1][1]):
             self.changes.append([timestamp, self.state])
+        self._serialized = self._fingerprint()
         return {
             'id': self.id,
             'version': self.version,
             'created_at': self.created_at,
             'state': self.state,
             'groups': self.groups,
+            'prestaged': self.prestaged,
+            'superseded_by': self.superseded_by,
+            'supersedes': self.supersedes,
             'last_update': timestamp,
             'bde_upload': self.bde_upload,
             'has_import_errors': self.has_import_errors,
@@ -67,8 +79,11 @@ class Job(object):
         }
 
 
-    def __init__(self, data, save_func=None):
+    def __init__(self, data, save_func=None, target_name=None):
         """ Use Job.create() and Job.parse() classmethods instead of this """
+        self.target_name = target_name
+        self._targets = {}
+        self._save_func = save_func
         # required
         self.id = data['id']
         self.version = data['version']
@@ -79,6 +94,9 @@ class Job(object):
         self.has_publish_errors = data['has_publish_errors']
         # optional
         self.groups = data.get('groups', {})
+        self.prestaged = data.get('prestaged', {})
+        self.superseded_by = data.get('superseded_by', None)
+        self.supersedes = data.get('supersedes', [])
         self.last_update = data.get('last_update', None)
         self.bde_upload = data.get('bde_upload', {})
         self.zendesk_ticket = data.get('zendesk_ticket', None)
@@ -86,17 +104,59 @@ class Job(object):
         if save_func:
             self.save = types.MethodType(save_func, self)
 
+        # new jobs are always modified
+        self._serialized = self._fingerprint() if 'last_update' in data else None
+
+    def _fingerprint(self):
+        """ Representation of the persisted state, used for change detection """
+        return json.dumps({
+            'state': self.state,
+            'groups': self.groups,
+            'prestaged': self.prestaged,
+            'superseded_by': self.superseded_by,
+            'supersedes': self.supersedes,
+            'bde_upload': self.bde_upload,
+            'has_import_errors': self.has_import_errors,
+            'has_publish_errors': self.has_publish_errors,
+            'zendesk_ticket': self.zendesk_ticket,
+        }, sort_keys=True, default=str)
+
+    def target(self, name):
+        """
+        The Job for an extra Koordinates target (koordinates.targets) with the
+        same BDE upload. It's saved separately from this Job.
+        """
+        if name not in self._targets:
+            data = {
+                'id': self.id,
+                'version': self.version,
+                'created_at': self.created_at,
+                'state': Job.STATE_NEW,
+                'has_import_errors': False,
+                'has_publish_errors': False,
+            }
+            self._targets[name] = Job(data, save_func=self._save_func, target_name=name)
+        return self._targets[name]
+
+    def with_targets(self):
+        """ This Job and the Jobs for any extra targets """
+        return [self] + [self._targets[name] for name in sorted(self._targets)]
+
+    def is_modified(self):
+        """ Whether the Job has changed since it was last loaded or saved """
+        return self._fingerprint() != self._serialized
+
     def __str__(self):
         props = {}
         for k, v in self.__dict__.items():
-            if k.startswith('_'):
+            if k.startswith('_') or k == 'target_name':
                 continue
             elif callable(v):
                 continue
             else:
                 props[k] = v
 
-        return "%s (%s):\n%s" % (
-            self.id, self.state,
+        return "%s%s (%s):\n%s" % (
+            self.id, (" [%s]" % self.target_name) if self.target_name else "", self.state,
             "\n".join(["  " + s for s in json.dumps(props, indent=2, default=str).splitlines()])
-        )
+        ) + "".join("\n" + str(self._targets[name]) for name in sorted(self._targets))
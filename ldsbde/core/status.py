@@ -0,0 +1,158 @@
+"""
+Read-only HTTP status server for the monitor.
+
+StatusBoard holds JSON-ready snapshots of the Jobs the monitor is tracking,
+and StatusServer serves them from memory, so status checks never read or
+race with the job files. Clients can long-poll for changes:
+
+    GET /jobs                       all tracked jobs, newest first
+    GET /jobs/<id>                  one job (with its extra targets)
+    GET /jobs?since=<v>&wait=<s>    block up to s seconds until the version is past v
+
+Responses include the board "version", which increases whenever anything changes.
+"""
+import json
+import logging
+import re
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+
+# longest a client can long-poll for (seconds)
+MAX_WAIT = 60
+
+
+def job_status(job):
+    """ A JSON-ready copy of a Job's state, without modifying it """
+    status = {
+        'id': job.id,
+        'target': job.target_name,
+        'created_at': job.created_at,
+        'state': job.state,
+        'last_update': job.last_update,
+        'bde_upload': job.bde_upload,
+        'groups': job.groups,
+        'superseded_by': job.superseded_by,
+        'has_import_errors': job.has_import_errors,
+        'has_publish_errors': job.has_publish_errors,
+        'changes': job.changes,
+    }
+    if not job.target_name:
+        status['targets'] = [job_status(j) for j in job.with_targets()[1:]]
+    # round-trip so we don't share any mutable state with the monitor
+    return json.loads(json.dumps(status, default=str))
+
+
+class StatusBoard(object):
+    """ Thread-safe, versioned snapshots of the monitored Jobs """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.version = 0
+        self.jobs = {}
+        self.info = {}
+
+    def update(self, jobs, **info):
+        """
+        Replace the tracked Jobs with snapshots of jobs (None keeps the
+        current ones), and set the monitor info (eg. last check time & errors).
+        The version only changes if something did.
+        """
+        info = json.loads(json.dumps(info, default=str))
+        snapshots = None if jobs is None else dict((job.id, job_status(job)) for job in jobs)
+        with self._cond:
+            if snapshots is None:
+                snapshots = self.jobs
+            if snapshots != self.jobs or info != self.info:
+                self.jobs = snapshots
+                self.info = info
+                self.version += 1
+                self._cond.notify_all()
+
+    def get(self, job_id=None, since=None, wait=0):
+        """
+        Get (version, data) for all the Jobs, or one if job_id is set.
+        If since is the current version, waits up to wait seconds for a change first.
+        Returns data None for unknown Jobs.
+        """
+        end = time.time() + min(wait, MAX_WAIT)
+        with self._cond:
+            while since is not None and self.version <= since:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            if job_id is not None:
+                return self.version, self.jobs.get(job_id)
+            return self.version, {
+                'monitor': self.info,
+                'jobs': [self.jobs[k] for k in sorted(self.jobs, reverse=True)],
+            }
+
+
+class StatusRequestHandler(BaseHTTPRequestHandler):
+    server_version = "lds-bde-loader"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        m = re.match(r'^/jobs(?:/([0-9]+))?/?$', url.path)
+        if not m:
+            return self._send(404, {'error': 'Not found'})
+
+        try:
+            since = int(query['since'][0]) if 'since' in query else None
+            wait = float(query.get('wait', ['30' if since is not None else '0'])[0])
+        except ValueError:
+            return self._send(400, {'error': 'since must be an integer and wait a number'})
+
+        job_id = int(m.group(1)) if m.group(1) else None
+        version, data = self.server.board.get(job_id, since=since, wait=wait)
+        if data is None:
+            return self._send(404, {'error': 'Job %s not found' % job_id, 'version': version})
+
+        if job_id is not None:
+            data = {'job': data}
+        data['version'] = version
+        self._send(200, data)
+
+    def _send(self, code, data):
+        body = json.dumps(data, indent=1, sort_keys=True).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger("ldsbde.status").debug("%s %s", self.address_string(), format % args)
+
+
+class StatusServer(ThreadingMixIn, HTTPServer):
+    """ Serves a StatusBoard over HTTP from a background thread """
+    daemon_threads = True
+
+    def __init__(self, board, host='127.0.0.1', port=8765):
+        HTTPServer.__init__(self, (host, port), StatusRequestHandler)
+        self.board = board
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="status-server")
+        self._thread.daemon = True
+        self._thread.start()
+        logging.getLogger("ldsbde.status").info("Serving status on http://%s:%s/jobs", *self.server_address[:2])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket rate limiter.
+    rate is in tokens/second, burst is the bucket capacity. A rate of None/0 is unlimited.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate or 0)
+        self.capacity = float(burst or max(1.0, self.rate))
+        self._tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Take a token, blocking until one is available. Returns the seconds waited. """
+        if not self.rate:
+            return 0
+
+        waited = 0
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class AdaptiveConcurrency(object):
+    """
+    AIMD (additive-increase/multiplicative-decrease) limit on in-flight requests.
+
+    Use as a context manager around each request, then call record() with the
+    outcome. The limit grows by one after `limit` consecutive healthy requests,
+    and is multiplied by `decrease` (at most once per `cooldown` seconds) when a
+    request errors or is slower than `latency_target`.
+    """
+    def __init__(self, initial=4, minimum=1, maximum=16, latency_target=10.0, decrease=0.5, cooldown=5.0):
+        self.log = logging.getLogger("ldsbde.throttle")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.limit = max(minimum, min(maximum, initial))
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._healthy = 0
+        self._last_decrease = 0
+
+    def __enter__(self):
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def record(self, elapsed, error=False):
+        """ Adjust the limit based on the outcome of a request """
+        with self._cond:
+            if error or (self.latency_target and elapsed > self.latency_target):
+                self._healthy = 0
+                now = time.time()
+                if now - self._last_decrease < self.cooldown:
+                    return
+                self._last_decrease = now
+                new_limit = max(self.minimum, int(self.limit * self.decrease))
+                if new_limit != self.limit:
+                    self.log.info("Reducing API concurrency %d -> %d (error=%s, %.1fs)", self.limit, new_limit, error, elapsed)
+                    self.limit = new_limit
+            else:
+                self._healthy += 1
+                if self._healthy >= self.limit and self.limit < self.maximum:
+                    self._healthy = 0
+                    self.limit += 1
+                    self.log.debug("Increasing API concurrency to %d", self.limit)
+                    self._cond.notify_all()
@@ -1,6 +1,8 @@
 import logging
 import logging.handlers
 from datetime import datetime
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
 from dateutil import tz
 from slacker import Slacker
@@ -11,6 +13,55 @@ def timestamp_local():
     return datetime.now(tz.tzlocal())
 
 
+def elapsed_seconds(start, end=None):
+    """
+    Return the number of seconds between two datetimes (end defaults to now).
+    Naive datetimes (eg. timestamps loaded back from YAML) are treated as UTC.
+    """
+    end = end or timestamp_local()
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=tz.tzutc())
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=tz.tzutc())
+    return (end - start).total_seconds()
+
+
+def parallel_map(func, items, workers):
+    """
+    Call func(item) for each item, using up to `workers` threads.
+    Returns a list of (item, result, exception) tuples in the original order;
+    exception is None if the call succeeded.
+    """
+    items = list(items)
+
+    def call(item):
+        try:
+            return (item, func(item), None)
+        except Exception as e:
+            return (item, None, e)
+
+    if workers <= 1 or len(items) <= 1:
+        return [call(item) for item in items]
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        results = pool.map_async(call, items, chunksize=1)
+        # with a timeout so Ctrl-C/SIGTERM still work
+        while True:
+            try:
+                results = results.get(timeout=1)
+                break
+            except TimeoutError:
+                pass
+    except BaseException:
+        # don't wait for the running calls, the worker threads are daemons
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return results
+
+
 class SlackLogHandler(logging.Handler):
     """
     logging Handler that sends messages to a Slack channel
@@ -27,6 +27,7 @@ setup(name='lds-bde-loader',
         'python-dateutil',
         'psycopg2',
         'PyYAML',
+        'requests>=2.4.0',  # requests.exceptions.ConnectTimeout
         'slacker',
     ],
     setup_requires=[],
@@ -41,11 +42,16 @@ setup(name='lds-bde-loader',
         check-import = ldsbde.cli.support:check_import
         start-import = ldsbde.cli.support:start_import
         continue-import = ldsbde.cli.support:continue_import
+        abandon = ldsbde.cli.support:abandon
         error-email = ldsbde.cli.support:error_email
         process-start = ldsbde.cli.process:start
         process-finish = ldsbde.cli.process:finish
         process-error = ldsbde.cli.process:error
         cron-monitor = ldsbde.cli.support:cron_monitor
+        count-benchmark = ldsbde.cli.support:count_benchmark
+        plan = ldsbde.cli.support:plan
+        archive = ldsbde.cli.support:archive
+        monitor = ldsbde.cli.support:monitor
     """,
     namespace_packages=[],
 )
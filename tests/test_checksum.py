@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import datetime
+import decimal
+import unittest
+
+from dateutil.tz import tzoffset, tzutc
+
+from ldsbde.core import checksum
+
+
+class CanonicalTest(unittest.TestCase):
+    def assertSame(self, db_value, csv_value):
+        self.assertEqual(checksum.canonical(db_value), checksum.canonical(csv_value))
+
+    def test_nulls(self):
+        self.assertSame(None, '')
+        self.assertSame(None, u'  ')
+
+    def test_booleans(self):
+        self.assertSame(True, 't')
+        self.assertSame(True, 'true')
+        self.assertSame('f', 'FALSE')
+        self.assertEqual(checksum.canonical(False), u'false')
+
+    def test_numbers(self):
+        self.assertSame(decimal.Decimal('1.50'), '1.5')
+        self.assertSame(decimal.Decimal('100'), '100.000')
+        self.assertSame('1.50', '1.5')
+        self.assertSame(0.1, '0.1')
+        self.assertSame(1234567.891, '1234567.891')
+        self.assertSame(12, '12')
+        self.assertNotEqual(checksum.canonical('1.5'), checksum.canonical('1.05'))
+
+    def test_dates(self):
+        self.assertSame(datetime.date(2016, 5, 1), '2016-05-01')
+        self.assertSame(datetime.datetime(2016, 5, 1, 12, 30, 0), '2016-05-01T12:30:00')
+        self.assertSame('2016-05-01 12:30:00', '2016-05-01T12:30:00.000')
+        self.assertSame(datetime.datetime(2016, 5, 1, 12, 30, 0, 500000), '2016-05-01 12:30:00.5')
+
+    def test_timezones(self):
+        nzst = tzoffset(None, 12 * 3600)
+        self.assertSame(datetime.datetime(2016, 5, 2, 0, 30, tzinfo=nzst), '2016-05-01T12:30:00Z')
+        self.assertSame(datetime.datetime(2016, 5, 1, 12, 30, tzinfo=tzutc()), '2016-05-01 12:30:00+00')
+        # as Postgres casts timestamptz to text
+        self.assertSame('2016-05-02 00:30:00+12', '2016-05-01T12:30:00Z')
+        self.assertSame('2016-05-01 08:00:00-04:30', '2016-05-01T12:30:00Z')
+        self.assertNotEqual(checksum.canonical('2016-05-01 12:30:00'), checksum.canonical('2016-05-01 12:30:00Z'))
+
+    def test_text(self):
+        self.assertSame(u'Wellington ', 'Wellington')
+        self.assertSame(u'Ōtaki'.encode('utf-8'), u'Ōtaki')
+
+
+class FingerprintTest(unittest.TestCase):
+    # the same rows as fetched from the database, and read from a CSV export
+    DB_ROWS = [
+        (1, decimal.Decimal('10.50'), datetime.date(2016, 5, 1), True, None),
+        (2, decimal.Decimal('3'), datetime.date(2016, 5, 2), False, u'Ōtaki'),
+        (3, 0.25, datetime.datetime(2016, 5, 3, 12, 0, tzinfo=tzutc()), True, u'x'),
+    ]
+    CSV_ROWS = [
+        ('3', '0.25', '2016-05-03T12:00:00Z', 'true', 'x'),
+        ('1', '10.5', '2016-05-01', 't', ''),
+        ('2', '3.0', '2016-05-02', 'f', u'Ōtaki'),
+    ]
+
+    def test_order_independent(self):
+        self.assertEqual(checksum.fingerprint_rows(self.DB_ROWS), checksum.fingerprint_rows(self.CSV_ROWS))
+        self.assertEqual(checksum.fingerprint_rows(self.DB_ROWS)[0], 3)
+
+    def test_detects_changes(self):
+        changed = list(self.CSV_ROWS)
+        changed[0] = ('3', '0.26', '2016-05-03T12:00:00Z', 'true', 'x')
+        self.assertNotEqual(checksum.fingerprint_rows(self.DB_ROWS), checksum.fingerprint_rows(changed))
+        self.assertNotEqual(checksum.fingerprint_rows(self.DB_ROWS), checksum.fingerprint_rows(self.CSV_ROWS[:2]))
+
+    def test_combine(self):
+        parts = checksum.combine(checksum.fingerprint_rows(self.DB_ROWS[:1]), checksum.fingerprint_rows(self.DB_ROWS[1:]))
+        self.assertEqual(parts, checksum.fingerprint_rows(self.CSV_ROWS))
+        self.assertEqual(checksum.combine(checksum.EMPTY, parts), parts)
+
+    def test_parallel_fingerprint(self):
+        db_batches = [self.DB_ROWS[:2], self.DB_ROWS[2:]]
+        csv_batches = [[row] for row in self.CSV_ROWS]
+        expected = checksum.fingerprint_rows(self.CSV_ROWS)
+
+        self.assertEqual(checksum.parallel_fingerprint(iter(db_batches)), expected)
+        pool = checksum.create_pool(2)
+        try:
+            self.assertEqual(checksum.parallel_fingerprint(iter(db_batches), pool, read_ahead=1), expected)
+            self.assertEqual(checksum.parallel_fingerprint(iter(csv_batches), pool), expected)
+            self.assertEqual(checksum.parallel_fingerprint(iter([]), pool), checksum.EMPTY)
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import threading
+import time
+import unittest
+
+import psycopg2.pool
+
+from ldsbde.core import db
+
+
+class FakeConnection(object):
+    closed = 0
+
+    def __init__(self):
+        self.last_used = time.time()
+
+    def rollback(self):
+        pass
+
+
+class FakePool(object):
+    """ Behaves like ThreadedConnectionPool: raises PoolError when exhausted """
+    def __init__(self, minconn, maxconn, **kwargs):
+        self.maxconn = maxconn
+        self.used = 0
+        self.max_used = 0
+        self._lock = threading.Lock()
+
+    def getconn(self):
+        with self._lock:
+            if self.used >= self.maxconn:
+                raise psycopg2.pool.PoolError("connection pool exhausted")
+            self.used += 1
+            self.max_used = max(self.max_used, self.used)
+            return FakeConnection()
+
+    def putconn(self, conn, close=False):
+        with self._lock:
+            self.used -= 1
+
+    def closeall(self):
+        pass
+
+
+class DatabaseConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self._pool_class = psycopg2.pool.ThreadedConnectionPool
+        psycopg2.pool.ThreadedConnectionPool = FakePool
+
+    def tearDown(self):
+        psycopg2.pool.ThreadedConnectionPool = self._pool_class
+
+    def test_waits_when_pool_is_exhausted(self):
+        database = db.Database({}, max_connections=2)
+        errors = []
+
+        def worker():
+            try:
+                with database.connection():
+                    time.sleep(0.05)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(database._pool.max_used, 2)
+        self.assertEqual(database._pool.used, 0)
+
+    def test_releases_slot_after_error(self):
+        database = db.Database({}, max_connections=1)
+        for i in range(3):
+            with self.assertRaises(ValueError):
+                with database.connection():
+                    raise ValueError("boom")
+
+        with database.connection() as conn:
+            self.assertFalse(conn.closed)
+        self.assertEqual(database._pool.used, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
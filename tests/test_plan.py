@@ -0,0 +1,51 @@
+import tempfile
+import unittest
+
+from ldsbde.core.bde import BDEProcessor, Upload
+from ldsbde.core.job import Job
+
+
+class PlanUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.bde = BDEProcessor({
+            'job_path': tempfile.mkdtemp(),
+            'koordinates': {'endpoint': 'example.com', 'api_token': 'x'},
+            'bde': {
+                'database': {},
+                'verify_batch_size': 2,
+                'tables': {1: 'lds.a', 2: 'lds.b', 3: 'lds.c', 4: 'lds.d'},
+                'groups': [
+                    {'name': 'g1', 'layers': [1]},
+                    {'name': 'g2', 'layers': [2, 3, 4]},
+                ],
+            },
+        })
+        self.bde.get_reference = lambda job_id: 'ldsbde0_%s' % job_id
+        self.bde.get_upload = lambda id: Upload(id, Upload.STATUS_COMPLETED, 'x', None, None)
+        self.job = Job.parse({
+            'id': 5,
+            'version': '0.2.dev',
+            'created_at': None,
+            'state': Job.STATE_BDE_FINISHED,
+            'has_import_errors': False,
+            'has_publish_errors': False,
+        })
+
+    def test_skips_superseded_groups(self):
+        self.job.groups = {'g1': {'superseded_by': 6}}
+        plan = self.bde.plan_update(self.job, lookup=False)
+
+        groups = dict((g['name'], g) for g in plan['groups'])
+        self.assertEqual(groups['g1']['superseded_by'], 6)
+        self.assertEqual(groups['g1']['layers'], [])
+        self.assertEqual([l['id'] for l in groups['g2']['layers']], [2, 3, 4])
+
+    def test_verify_statements_per_group(self):
+        plan = self.bde.plan_update(self.job, lookup=False)
+        # g1: 1 batch, g2: 2 batches of up to 2
+        self.assertEqual(plan['db_queries']['verify_statements'], 3)
+        self.assertEqual(plan['db_queries']['ver_get_diff'], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()